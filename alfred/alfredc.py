@@ -0,0 +1,55 @@
+#!/usr/bin/python3
+#
+# Alfred script filter client for the resident query daemon (alfredd.py)
+#
+# Usage:
+#   alfredc.py qref|meetings|tags [<query>]
+#
+# Passes the query to the daemon and prints its answer. If the daemon is not
+# running, the filter script is run directly instead.
+
+import os, sys, socket, json
+
+# settings
+socketFile = os.path.expanduser('~')+'/.quiver/alfred.sock'   # daemon socket
+timeout    = 2.0                                              # seconds to wait for the daemon
+
+# usage
+def usage():
+  print('''
+Usage:
+  alfredc.py qref|meetings|tags [<query>]
+''')
+  exit(1)
+
+# arguments
+nargs = len(sys.argv)
+if nargs < 2 or nargs > 3 or sys.argv[1] not in ['qref', 'meetings', 'tags']:
+  usage()
+name = sys.argv[1]
+query = sys.argv[2] if nargs > 2 else ''
+
+# ask the daemon
+out = b''
+try:
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  s.settimeout(timeout)
+  s.connect(socketFile)
+  s.sendall(json.dumps({ 'filter': name, 'query': query }).encode('utf-8')+b'\n')
+  while True:
+    data = s.recv(65536)
+    if not data:
+      break
+    out += data
+  s.close()
+except OSError:
+  out = b''
+if len(out) > 0:
+  sys.stdout.write(out.decode('utf-8')+'\n')
+  exit(0)
+
+# run the filter directly
+here = os.path.dirname(os.path.realpath(__file__))
+if name == 'tags':
+  os.execv('/bin/bash', ['bash', os.path.join(here, 'tags.sh')])
+os.execv(sys.executable, [sys.executable, os.path.join(here, name+'.py')]+sys.argv[2:])
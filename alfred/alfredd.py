@@ -0,0 +1,138 @@
+#!/usr/bin/python3
+#
+# Resident query daemon for the Alfred script filters
+#
+# Usage:
+#   alfredd.py
+#
+# Keeps the Quiver tag list, the qref lookup index and the meetings cache in
+# memory, and answers script filter queries over a Unix domain socket, so that
+# keystrokes do not pay for interpreter startup, imports and file loads. The tag
+# list is kept up to date by watching the Quiver library, the qref index is
+# reloaded when the reference note changes, and the meetings cache when it has
+# been refreshed.
+#
+# Each request is a single line of json, {"filter": <name>, "query": <query>},
+# answered with the script filter output. The workflows call alfredc.py, which
+# falls back to running the filters directly if the daemon is not running.
+
+import os, sys, time, json, signal, socket, socketserver, threading
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'quiver'))
+from quiverlib import catalog_open, catalog_refresh, catalog_update, catalog_tags, watch
+import qref, meetings
+
+# settings
+home         = os.path.expanduser('~')
+quiverRoot   = home+'/Dropbox/apps/Quiver.qvlibrary'     # Quiver notebook path
+trash        = 'Trash.qvnotebook'                        # Quiver trash notebook to ignore
+catalogFile  = home+'/.quiver/catalog.db'                # local note catalog
+socketFile   = home+'/.quiver/alfred.sock'               # socket to listen on
+retry        = 30                                        # seconds to wait before restarting a failed library watch
+
+# in-memory state, replaced as a whole when reloaded
+state = { 'tags': [], 'qref': None, 'meetings': None, 'meetings_mtime': None }
+lock = threading.Lock()
+
+# keep the tag list up to date as the Quiver library changes
+# errors (a locked catalog, a notebook that vanished while being read) are logged,
+# and the next change does a full refresh, so the thread never dies
+def watch_tags():
+  db = None
+  full = True
+  while True:
+    try:
+      if db is None:
+        db = catalog_open(catalogFile)
+      if full:
+        catalog_refresh(db, quiverRoot, trash)
+        state['tags'] = catalog_tags(db)
+        full = False
+      for roots in watch(quiverRoot, trash):
+        try:
+          if roots is None or full:
+            n = catalog_refresh(db, quiverRoot, trash)
+            full = False
+          else:
+            n = catalog_update(db, quiverRoot, roots, trash)
+          if n > 0:
+            state['tags'] = catalog_tags(db)
+        except Exception as e:
+          print('Tag update failed:', repr(e), file=sys.stderr)
+          full = True
+    except Exception as e:
+      print('Tag watch failed:', repr(e), file=sys.stderr)
+      full = True
+    time.sleep(retry)
+
+# tags filter: all tags, or tags containing the query
+def tags(query):
+  query = query.strip().lower()
+  return { 'items': [{ 'arg': t, 'title': t } for t in state['tags'] if query in t.lower()] }
+
+# qref filter, reloading the index if the reference note has changed
+def qref_filter(query):
+  st = os.stat(qref.FILE)
+  with lock:
+    if state['qref'] is None or state['qref']['stamp'] != (st.st_mtime, st.st_size):
+      state['qref'] = qref.load()
+    index = state['qref']
+  return qref.filter_items(index, query)
+
+# meetings filter, reloading the cache if it has been refreshed
+def meetings_filter(query):
+  try:
+    mtime = os.path.getmtime(meetings.cacheFile)
+  except OSError:
+    mtime = None
+  with lock:
+    if mtime != state['meetings_mtime']:
+      state['meetings'] = meetings.load()
+      state['meetings_mtime'] = mtime
+    cache = state['meetings']
+  return meetings.filter_items(cache)
+
+filters = { 'tags': tags, 'qref': qref_filter, 'meetings': meetings_filter }
+
+# answer a single query
+class Handler(socketserver.StreamRequestHandler):
+  def handle(self):
+    line = self.rfile.readline()
+    if not line:
+      return
+    try:
+      req = json.loads(line.decode('utf-8'))
+      out = filters[req['filter']](req.get('query', ''))
+    except Exception as e:
+      out = { 'items': [{ 'title': 'Error', 'subtitle': repr(e), 'valid': False }] }
+    try:
+      self.wfile.write(json.dumps(out).encode('utf-8'))
+    except OSError:
+      pass
+
+class Server(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+  daemon_threads = True
+
+# refuse to start if another daemon is answering on the socket
+if os.path.exists(socketFile):
+  s = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+  try:
+    s.connect(socketFile)
+    print('Already running on', socketFile)
+    exit(1)
+  except OSError:
+    os.remove(socketFile)
+  finally:
+    s.close()
+elif not os.path.isdir(os.path.dirname(socketFile)):
+  os.makedirs(os.path.dirname(socketFile))
+
+signal.signal(signal.SIGTERM, lambda *args: sys.exit(0))
+threading.Thread(target=watch_tags, daemon=True).start()
+server = Server(socketFile, Handler)
+os.chmod(socketFile, 0o600)
+print('Listening on', socketFile)
+sys.stdout.flush()
+try:
+  server.serve_forever()
+finally:
+  os.remove(socketFile)
@@ -1,34 +1,117 @@
 #!/Users/mandar/anaconda3/bin/python
+#
+# Alfred script filter listing calendar events in the 8 hours around now
+#
+# Events are answered from a local cache of the calendar. When the cache is
+# older than ttl seconds, it is refreshed in a background process and Alfred is
+# asked to rerun the filter, so results never wait for the network. The Google
+# API client is only imported when refreshing.
+#
+# Usage:
+#   meetings.py            print Alfred items
+#   meetings.py --refresh  refresh the cache
 
-import datetime, time
-from googleapiclient.discovery import build
-from httplib2 import Http
-from oauth2client import file, client, tools
-
-store = file.Storage('/Users/mandar/.google/token-cal.json')
-creds = store.get()
-if not creds or creds.invalid:
-    flow = client.flow_from_clientsecrets('/Users/mandar/.google/credentials.json', 'https://www.googleapis.com/auth/calendar.readonly')
-    creds = tools.run_flow(flow, store)
-service = build('calendar', 'v3', http=creds.authorize(Http()))
-
-now = datetime.datetime.utcnow()
-start = now - datetime.timedelta(hours=8)
-end = now + datetime.timedelta(hours=8)
-events_result = service.events().list(calendarId='primary',
-                                    timeMin=start.isoformat()+'Z',
-                                    timeMax=end.isoformat()+'Z',
-                                    singleEvents=True,
-                                    orderBy='startTime').execute()
-events = events_result.get('items', [])
-
-print('{ "items": [')
-for event in events:
-    start = event['start'].get('dateTime', event['start'].get('date'))
-    start = start[:10] + ' ' + start[11:19]
-    dts = time.strptime(start, '%Y-%m-%d %H:%M:%S')
-    dts = '%02d/%02d %02d:%02d'%(dts[2],dts[1],dts[3],dts[4])
-    title = event['summary']
-    print('  { "title": "'+title+'", "subtitle": "'+dts+'", "arg": "'+title+'" },')
-print(']}')
+import os, sys, json, time
 
+# settings
+home      = os.path.expanduser('~')
+cacheFile = home+'/.google/cache/meetings.json'            # cached calendar events
+token     = home+'/.google/token-cal.json'                 # Google oauth token
+window    = 8*3600                                         # seconds before and after now to list
+margin    = 3600                                           # extra seconds of events to cache
+ttl       = float(os.environ.get('meetings_ttl', 300))     # seconds before refreshing the cache
+lockTTL   = 60                                             # seconds before a refresh is assumed dead
+
+# seconds since the epoch of a Google calendar event time
+def timestamp(t):
+    import datetime
+    s = t.get('dateTime', t.get('date'))
+    if len(s) == 10:
+        return time.mktime(time.strptime(s, '%Y-%m-%d'))
+    return datetime.datetime.fromisoformat(s.replace('Z', '+00:00')).timestamp()
+
+# fetch events from Google calendar and write them to the cache
+def refresh():
+    sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'productivity'))
+    import datetime
+    from googlelib import google_service, list_all
+    service, http = google_service('calendar', 'v3', 'https://www.googleapis.com/auth/calendar.readonly', token)
+    now = datetime.datetime.utcnow()
+    start = now - datetime.timedelta(seconds=window+margin)
+    end = now + datetime.timedelta(seconds=window+margin)
+    events = []
+    for event in list_all(service.events().list, calendarId='primary',
+                          timeMin=start.isoformat()+'Z',
+                          timeMax=end.isoformat()+'Z',
+                          singleEvents=True,
+                          orderBy='startTime'):
+        start = event['start'].get('dateTime', event['start'].get('date'))
+        start = (start[:10] + ' ' + start[11:19]).strip()
+        dts = time.strptime(start, '%Y-%m-%d %H:%M:%S' if len(start) > 10 else '%Y-%m-%d')
+        events.append({
+            'title': event.get('summary', ''),
+            'subtitle': '%02d/%02d %02d:%02d'%(dts[2],dts[1],dts[3],dts[4]),
+            'start': timestamp(event['start']),
+            'end': timestamp(event['end'])
+        })
+    folder = os.path.dirname(cacheFile)
+    if not os.path.isdir(folder):
+        os.makedirs(folder)
+    with open(cacheFile+'.tmp', 'w', encoding='utf-8') as f:
+        json.dump({ 'time': time.time(), 'events': events }, f)
+    os.replace(cacheFile+'.tmp', cacheFile)
+
+# start a background refresh, unless one is already running
+def refresh_background():
+    lock = cacheFile+'.lock'
+    try:
+        if time.time() - os.path.getmtime(lock) < lockTTL:
+            return
+        os.remove(lock)
+    except OSError:
+        pass
+    try:
+        os.close(os.open(lock, os.O_CREAT | os.O_EXCL))
+    except OSError:
+        return
+    import subprocess
+    subprocess.Popen([sys.executable, os.path.realpath(__file__), '--refresh'],
+        stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, start_new_session=True)
+
+# read the cache
+#   returns: cached data (dictionary), or None if there is no cache
+def load():
+    try:
+        with open(cacheFile, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+# Alfred items for the cached events around now
+#   A background refresh is started if the cache is stale (or missing).
+#   params: cached data (or None)
+#   returns: Alfred script filter output (dictionary)
+def filter_items(cache):
+    now = time.time()
+    items = []
+    for event in (cache['events'] if cache is not None else []):
+        if event['end'] > now-window and event['start'] < now+window:
+            items.append({ 'title': event['title'], 'subtitle': event['subtitle'], 'arg': event['title'] })
+    out = { 'items': items }
+    if cache is None or now - cache['time'] > ttl:
+        refresh_background()
+        out['rerun'] = 1
+    return out
+
+if __name__ == '__main__':
+    # a failed refresh leaves its lock in place, so it is retried after lockTTL seconds
+    if len(sys.argv) > 1 and sys.argv[1] == '--refresh':
+        refresh()
+        os.remove(cacheFile+'.lock')
+        exit(0)
+
+    cache = load()
+    if cache is None:
+        refresh()
+        cache = load()
+    print(json.dumps(filter_items(cache)))
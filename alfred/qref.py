@@ -1,18 +1,107 @@
 #!/usr/bin/python3
+#
+# Alfred script filter looking up keys in a Quiver key: value reference note
+#
+# The first cell of the note holds one "key: value" entry per line. The entries
+# are kept in a pickled index sorted by key, rebuilt only when the note changes,
+# so each keystroke costs one stat and one index load. Matches are ranked: exact
+# keys first, then keys starting with the query, keys with a word starting with
+# the query, keys containing the query, and finally keys containing the letters
+# of the query in order.
 
-import json, re, sys
+import os, sys, json, re, pickle, bisect
 
-FILE='/Users/mandar/GDrive/Apps/Quiver/Quiver.qvlibrary/D7D4B4F5-01DF-4C64-960C-1003216F466B.qvnotebook/F4A197BD-6A2E-4E34-9094-1B5F596FCE9C.qvnote/content.json'
+# settings
+FILE      = '/Users/mandar/GDrive/Apps/Quiver/Quiver.qvlibrary/D7D4B4F5-01DF-4C64-960C-1003216F466B.qvnotebook/F4A197BD-6A2E-4E34-9094-1B5F596FCE9C.qvnote/content.json'
+indexFile = os.path.expanduser('~')+'/.quiver/qref.pickle'   # lookup index
+maxItems  = 50                                               # maximum number of items listed
 
-with open(FILE) as f:
-  s = json.load(f)
+# build lookup index from reference note
+#   params: (mtime, size) of reference note
+#   returns: index (dictionary)
+def build(stamp):
+  with open(FILE, encoding='utf-8') as f:
+    s = json.load(f)
+  entries = []
+  for line in s['cells'][0]['data'].split('\n'):
+    if ':' in line:
+      k, v = line.split(':', 1)
+      k = re.sub(r'^\*', '', k).strip()
+      entries.append((k.lower(), k, v.strip()))
+  entries.sort()
+  index = { 'stamp': stamp, 'keys': [e[0] for e in entries], 'entries': entries }
+  folder = os.path.dirname(indexFile)
+  if not os.path.isdir(folder):
+    os.makedirs(folder)
+  with open(indexFile+'.tmp', 'wb') as f:
+    pickle.dump(index, f, pickle.HIGHEST_PROTOCOL)
+  os.replace(indexFile+'.tmp', indexFile)
+  return index
 
-print('{"items": [')
-data = s['cells'][0]['data']
-for line in data.split('\n'):
-  k, v = line.split(':')
-  k = re.sub(r'^\*', '', k).strip()
-  v = v.strip()
-  if re.search(r'%s' % sys.argv[1], k, re.IGNORECASE):
-    print('  {"uid": "'+k+'", "arg": "'+v+'", "title": "'+k+'", "subtitle": "'+v+'"},')
-print(']}')
+# lookup index, rebuilt if the reference note has changed
+def load():
+  st = os.stat(FILE)
+  stamp = (st.st_mtime, st.st_size)
+  try:
+    with open(indexFile, 'rb') as f:
+      index = pickle.load(f)
+    if index['stamp'] == stamp:
+      return index
+  except (OSError, ValueError, KeyError, EOFError, pickle.UnpicklingError):
+    pass
+  return build(stamp)
+
+# fuzzy match score: spread of the query letters in order in the key
+#   returns: score (smaller is better), or None if the letters do not all appear in order
+def fuzzy(query, key):
+  pos = -1
+  first = None
+  for c in query:
+    pos = key.find(c, pos+1)
+    if pos < 0:
+      return None
+    if first is None:
+      first = pos
+  return pos - first - len(query) + 1
+
+# ranked matches of query
+#   params: index, query
+#   returns: list of (key, value) tuples, best first
+def lookup(index, query):
+  query = query.strip().lower()
+  keys, entries = index['keys'], index['entries']
+  if query == '':
+    return [e[1:] for e in entries[:maxItems]]
+  ranked = []
+  lo = bisect.bisect_left(keys, query)
+  hi = bisect.bisect_left(keys, query+'\uffff', lo)
+  for i in range(lo, hi):
+    ranked.append((0 if keys[i] == query else 1, len(keys[i]), i))
+  for i in range(0, lo):
+    rank(ranked, query, keys[i], i)
+  for i in range(hi, len(keys)):
+    rank(ranked, query, keys[i], i)
+  ranked.sort()
+  return [entries[r[2]][1:] for r in ranked[:maxItems]]
+
+# add a non-prefix match of query to ranked results
+def rank(ranked, query, key, i):
+  pos = key.find(query)
+  if pos > 0:
+    ranked.append((2 if not key[pos-1].isalnum() else 3, pos, i))
+  else:
+    score = fuzzy(query, key)
+    if score is not None:
+      ranked.append((4, score, i))
+
+# Alfred items for the ranked matches of query
+#   params: index, query
+#   returns: Alfred script filter output (dictionary)
+def filter_items(index, query):
+  items = []
+  for k, v in lookup(index, query):
+    items.append({ 'uid': k, 'arg': v, 'title': k, 'subtitle': v })
+  return { 'items': items }
+
+if __name__ == '__main__':
+  print(json.dumps(filter_items(load(), sys.argv[1] if len(sys.argv) > 1 else '')))
@@ -0,0 +1,379 @@
+#!/usr/bin/python
+#
+# Benchmark Quiver tools against a synthetic Quiver library
+#
+# Usage:
+#   quiver-bench.py generate <folder> <notes>
+#   quiver-bench.py run <notes> [<results-file>]
+#
+# The generate verb creates a synthetic Quiver.qvlibrary in the folder, with a
+# realistic mix of notebooks, notes, cells (markdown with @todo/@due/@repeat
+# tags, code, text with images, latex) and resources.
+#
+# The run verb generates a library of the given size in a temporary folder, and
+# times quiver2md, md2quiver, the catalog/library walk and the @todo extraction
+# in sync-quiver-gtasks.py (with Google APIs stubbed out, so no network access is
+# needed), and batched task creation against a simulated Google API quota (with
+# rate limiting and retries, starting from an unknown rate). Time, throughput and
+# peak memory (from a second, traced run) of each benchmark are printed, and
+# written as json to the results file if specified.
+
+import os, sys, json, uuid, random, time, tempfile, shutil, tracemalloc, subprocess, types, runpy, platform, sqlite3
+
+# settings
+here         = os.path.dirname(os.path.realpath(__file__))
+quiverDir    = os.path.join(here, '..', 'quiver')
+syncScript   = os.path.join(here, '..', 'productivity', 'sync-quiver-gtasks.py')
+notesPerBook = 50                                        # average notes per notebook
+seed         = 42                                        # random seed for reproducible libraries
+quotaRate    = 100                                       # simulated Google API quota, requests per second
+quotaTasks   = 500                                       # tasks to create against the simulated quota
+
+sys.path.insert(0, quiverDir)
+sys.path.insert(0, os.path.dirname(syncScript))
+import quiverlib
+
+# usage
+def usage():
+  print('''
+Usage:
+  quiver-bench.py generate <folder> <notes>
+  quiver-bench.py run <notes> [<results-file>]
+''')
+  exit(1)
+
+# random text
+words = 'the quick brown fox jumps over lazy dog quiver note task sync markdown cell code library'.split()
+def text(rnd, n):
+  return ' '.join(rnd.choice(words) for i in range(n))
+
+# random markdown cell
+def markdown_cell(rnd, resources):
+  lines = ['# '+text(rnd, 4).title()]
+  for i in range(rnd.randint(3, 30)):
+    r = rnd.random()
+    if r < 0.1:
+      lines.append('- [ ] '+text(rnd, 5)+' @todo')
+    elif r < 0.15:
+      lines.append('- [ ] '+text(rnd, 5)+' @todo @due(2020-%02d-%02d)'%(rnd.randint(1, 12), rnd.randint(1, 28)))
+    elif r < 0.18:
+      lines.append('- '+text(rnd, 4)+' @repeat(weekday=%d, due=+1)'%rnd.randint(1, 7))
+    elif r < 0.2:
+      lines.append('- [x] '+text(rnd, 5)+' @done(2019-01-01)')
+    elif r < 0.23:
+      f = str(uuid.UUID(int=rnd.getrandbits(128))).upper()+'.png'
+      resources.append(f)
+      lines.append('![image](quiver-image-url/'+f+')')
+    else:
+      lines.append(text(rnd, rnd.randint(5, 20)))
+  return { 'type': 'markdown', 'data': '\n'.join(lines) }
+
+# random cell
+def cell(rnd, resources):
+  r = rnd.random()
+  if r < 0.6:
+    return markdown_cell(rnd, resources)
+  if r < 0.8:
+    return { 'type': 'code', 'language': 'python', 'data': '\n'.join('x = '+text(rnd, 3) for i in range(rnd.randint(1, 40))) }
+  if r < 0.95:
+    f = str(uuid.UUID(int=rnd.getrandbits(128))).upper()+'.png'
+    resources.append(f)
+    body = ''.join('<p>'+text(rnd, 20)+'</p>' for i in range(300 if rnd.random() < 0.02 else rnd.randint(1, 10)))
+    return { 'type': 'text', 'data': '<div>'+body+'<img src="quiver-image-url/'+f+'"></div>' }
+  return { 'type': 'latex', 'data': 'x^2 + y^2 = z^2' }
+
+# generate a synthetic Quiver library
+#   params: library folder, number of notes
+#   returns: number of bytes written
+def generate(root, notes):
+  rnd = random.Random(seed)
+  size = 0
+  nbooks = max(1, notes//notesPerBook)
+  books = ['Inbox'] + [str(uuid.UUID(int=rnd.getrandbits(128))).upper() for i in range(nbooks-1)]
+  for i in range(notes + notes//100 + 1):
+    nb = books[i % len(books)] if i < notes else 'Trash'
+    nbroot = os.path.join(root, nb+'.qvnotebook')
+    if not os.path.isdir(nbroot):
+      os.makedirs(nbroot)
+      with open(os.path.join(nbroot, 'meta.json'), 'w', encoding='utf-8') as f:
+        json.dump({ 'name': nb if nb in ('Inbox', 'Trash') else text(rnd, 2).title(), 'uuid': nb }, f)
+    nid = str(uuid.UUID(int=rnd.getrandbits(128))).upper()
+    root1 = os.path.join(nbroot, nid+'.qvnote')
+    os.mkdir(root1)
+    resources = []
+    title = text(rnd, 4).title()
+    meta = { 'title': title, 'uuid': nid, 'tags': rnd.sample(words, rnd.randint(0, 3)), 'created_at': 1500000000+i, 'updated_at': 1500000000+i }
+    content = { 'title': title, 'cells': [cell(rnd, resources) for j in range(rnd.randint(1, 12))] }
+    for name, data in (('meta.json', meta), ('content.json', content)):
+      s = json.dumps(data, indent=2)
+      size += len(s)
+      with open(os.path.join(root1, name), 'w', encoding='utf-8') as f:
+        f.write(s)
+    if len(resources) > 0:
+      os.mkdir(os.path.join(root1, 'resources'))
+      for r in resources:
+        n = rnd.choice([100, 1000, 10000])
+        data = rnd.getrandbits(8*n).to_bytes(n, 'little')
+        size += len(data)
+        with open(os.path.join(root1, 'resources', r), 'wb') as f:
+          f.write(data)
+  return size
+
+# stub out Google API client modules, so that scripts run without network access
+#   A quota of requests per second can be simulated, answering requests over it
+#   with 429 errors like the Google APIs do.
+class _Response(dict):
+  def __init__(self, status, headers={}):
+    dict.__init__(self, headers)
+    self.status = status
+
+class _HttpError(Exception):
+  def __init__(self, status, reason):
+    Exception.__init__(self, '<HttpError %d "%s">'%(status, reason))
+    self.resp = _Response(status)
+    self.content = json.dumps({ 'error': { 'code': status, 'errors': [{ 'reason': reason }] } }).encode('utf-8')
+
+class _Quota(object):
+  rate = None     # requests per second, None for no quota
+  tokens = 0.0
+  stamp = 0.0
+  rejected = 0
+  @staticmethod
+  def check():
+    if _Quota.rate is None:
+      return
+    now = time.time()
+    _Quota.tokens = min(_Quota.rate, _Quota.tokens + (now - _Quota.stamp)*_Quota.rate)
+    _Quota.stamp = now
+    if _Quota.tokens < 1:
+      _Quota.rejected += 1
+      raise _HttpError(429, 'rateLimitExceeded')
+    _Quota.tokens -= 1
+
+class _Request(object):
+  def __init__(self, result):
+    self.result = result
+  def execute(self, *args, **kwargs):
+    _Quota.check()
+    return self.result
+
+class _Tasks(object):
+  count = 0
+  def list(self, **kwargs):
+    return _Request({ 'items': [] })
+  def insert(self, tasklist=None, body=None):
+    _Tasks.count += 1
+    return _Request({ 'id': 'T'+str(_Tasks.count) })
+  def delete(self, **kwargs):
+    return _Request({})
+
+class _TaskLists(object):
+  def list(self, **kwargs):
+    return _Request({ 'items': [{ 'title': 'Inbox', 'id': 'L1' }] })
+
+class _Batch(object):
+  def __init__(self, callback):
+    self.callback = callback
+    self.requests = []
+  def add(self, request, request_id=None):
+    self.requests.append((request_id, request))
+  def execute(self):
+    for rid, request in self.requests:
+      try:
+        self.callback(rid, request.execute(), None)
+      except _HttpError as e:
+        self.callback(rid, None, e)
+
+class _Service(object):
+  def new_batch_http_request(self, callback=None):
+    return _Batch(callback)
+  def tasks(self):
+    return _Tasks()
+  def tasklists(self):
+    return _TaskLists()
+
+class _Http(object):
+  def __init__(self, *args, **kwargs):
+    pass
+  def request(self, uri, *args, **kwargs):
+    return types.SimpleNamespace(status=200), b'{}'
+
+class _Creds(object):
+  invalid = False
+  def authorize(self, http):
+    return http
+
+class _Storage(object):
+  def __init__(self, *args):
+    pass
+  def get(self):
+    return _Creds()
+
+def stub_google():
+  mods = {}
+  for name in ['googleapiclient', 'googleapiclient.discovery', 'httplib2', 'oauth2client']:
+    mods[name] = types.ModuleType(name)
+  mods['googleapiclient.discovery'].build = lambda *args, **kwargs: _Service()
+  mods['googleapiclient.discovery'].build_from_document = lambda *args, **kwargs: _Service()
+  mods['httplib2'].Http = _Http
+  mods['oauth2client'].file = types.SimpleNamespace(Storage=_Storage)
+  mods['oauth2client'].client = types.SimpleNamespace()
+  mods['oauth2client'].tools = types.SimpleNamespace()
+  sys.modules.update(mods)
+
+# time a benchmark, and measure its peak memory in a second run
+#   params: benchmark name, function returning (items, bytes) processed, setup function run before each run
+#   returns: results (dictionary)
+def bench(name, func, setup=None):
+  if setup:
+    setup()
+  t0 = time.perf_counter()
+  items, nbytes = func()
+  dt = time.perf_counter() - t0
+  if setup:
+    setup()
+  tracemalloc.start()
+  func()
+  _, peak = tracemalloc.get_traced_memory()
+  tracemalloc.stop()
+  result = {
+    'name': name,
+    'seconds': dt,
+    'items': items,
+    'bytes': nbytes,
+    'items_per_second': items/dt if dt > 0 else None,
+    'mb_per_second': nbytes/dt/1e6 if dt > 0 else None,
+    'peak_memory': peak
+  }
+  print('%-24s %9.3f s %12.0f items/s %9.2f MB/s %9.1f MB peak'%(name, dt, result['items_per_second'] or 0, result['mb_per_second'] or 0, peak/1e6))
+  return result
+
+# run all benchmarks
+def run(notes, outfile):
+  tmp = tempfile.mkdtemp(prefix='quiver-bench-')
+  home = os.path.join(tmp, 'home')
+  quiverRoot = os.path.join(home, 'Dropbox', 'apps', 'Quiver.qvlibrary')
+  t0 = time.perf_counter()
+  size = generate(quiverRoot, notes)
+  print('Generated', notes, 'notes (%.1f MB) in %.1f s'%(size/1e6, time.perf_counter()-t0))
+  results = []
+  catfile = os.path.join(tmp, 'catalog.db')
+
+  def rmcat():
+    if os.path.exists(catfile):
+      os.remove(catfile)
+
+  def catalog():
+    db = quiverlib.catalog_open(catfile)
+    quiverlib.catalog_refresh(db, quiverRoot)
+    n = db.execute('SELECT COUNT(*) FROM notes').fetchone()[0]
+    db.close()
+    return n, 0
+
+  results.append(bench('catalog_refresh_cold', catalog, rmcat))
+  results.append(bench('catalog_refresh_warm', catalog))
+
+  def library():
+    lib = quiverlib.Library(quiverRoot, catalog=quiverlib.catalog_open(catfile))
+    return len(list(lib.notes())), 0
+
+  results.append(bench('library_load_warm', library))
+
+  lib = quiverlib.Library(quiverRoot, catalog=quiverlib.catalog_open(catfile), cachesize=0)
+  docs = []
+  for note in lib.notes():
+    with open(os.path.join(note.root, 'meta.json'), encoding='utf-8') as f:
+      meta = json.load(f)
+    docs.append((note.content, meta, note.info()))
+  mds = []
+
+  def q2m():
+    del mds[:]
+    nbytes = 0
+    for content, meta, info in docs:
+      mds.append(quiverlib.quiver2md(content, meta, info))
+      nbytes += len(mds[-1])
+    return len(docs), nbytes
+
+  results.append(bench('quiver2md', q2m))
+
+  def m2q():
+    for md in mds:
+      quiverlib.md2quiver(md, 0, 0)
+    return len(mds), sum(len(md) for md in mds)
+
+  results.append(bench('md2quiver', m2q))
+  del docs[:], mds[:]
+
+  def sync():
+    stub_google()
+    import googlelib
+    googlelib.limiter = googlelib.RateLimiter(1e9)
+    googlelib.limiter.name = 'bench'    # as if learned already, so no rates are read or saved
+    googlelib.cacheDir = os.path.join(tmp, 'cache')
+    env = os.environ.get('HOME')
+    os.environ['HOME'] = home
+    try:
+      runpy.run_path(syncScript, run_name='__main__')
+    finally:
+      if env is not None:
+        os.environ['HOME'] = env
+    db = sqlite3.connect(os.path.join(home, '.quiver', 'tasksync.db'))
+    n = db.execute('SELECT COUNT(*) FROM tasks').fetchone()[0]
+    db.close()
+    return n, 0
+
+  def rmsync():
+    fname = os.path.join(home, '.quiver', 'tasksync.db')
+    if os.path.exists(fname):
+      os.remove(fname)
+
+  results.append(bench('sync_todo_extract_cold', sync, rmsync))
+  results.append(bench('sync_todo_extract_warm', sync))
+
+  def quota():
+    stub_google()
+    import googlelib
+    googlelib.limiter = googlelib.RateLimiter()
+    googlelib.limiter.name = 'bench'
+    _Quota.rate, _Quota.tokens, _Quota.stamp, _Quota.rejected = quotaRate, 0.0, time.time(), 0
+    service = _Service()
+    try:
+      created = googlelib.batch_execute(service, [service.tasks().insert(tasklist='L1', body={}) for i in range(quotaTasks)])
+    finally:
+      _Quota.rate = None
+    print('Rejected', _Quota.rejected, 'requests, learned rate %.1f requests/s'%googlelib.limiter.rate)
+    return sum(1 for response, e in created if e is None), 0
+
+  results.append(bench('google_quota_create', quota))
+
+  if outfile:
+    try:
+      commit = subprocess.check_output(['git', 'rev-parse', 'HEAD'], cwd=here, stderr=subprocess.DEVNULL).decode().strip()
+    except Exception:
+      commit = None
+    with open(outfile, 'w', encoding='utf-8') as f:
+      json.dump({
+        'commit': commit,
+        'time': time.time(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'notes': notes,
+        'library_bytes': size,
+        'results': results
+      }, f, indent=2)
+    print('Results written to', outfile)
+  shutil.rmtree(tmp)
+
+# arguments
+nargs = len(sys.argv)
+if nargs < 3 or sys.argv[1] not in ['generate', 'run']:
+  usage()
+if sys.argv[1] == 'generate':
+  if nargs != 4:
+    usage()
+  generate(sys.argv[2], int(sys.argv[3]))
+else:
+  if nargs > 4:
+    usage()
+  run(int(sys.argv[2]), sys.argv[3] if nargs > 3 else None)
@@ -1,79 +1,127 @@
-import requests, os, os.path, urllib.parse, re
+import requests, os, os.path, urllib.parse, re, ast, sqlite3, email.utils
+from requests.adapters import HTTPAdapter
+from pipeline import github_issues, buffered, dedup, twodo_sink, counted, stats, report
+import metrics
 
 # settings
 folder = '~/.github2do'
+api = 'https://api.github.com'          # github API
+workers = 4                             # concurrent page fetches
+perPage = 100                           # issues per page
 
 # load auth details
+metrics.start('github2do')
 folder = os.path.expanduser(folder)
 auth = [s.strip() for s in open(folder+'/auth.txt', 'rt')]
 auth = tuple(auth[:2])
 
-issues = dict()
+# open state: ids of issues already turned into tasks, and the last conditional request
+#   The old issues.txt issue list is imported on first use.
+def open_state(fname):
+  db = sqlite3.connect(fname)
+  db.executescript('''
+    CREATE TABLE IF NOT EXISTS seen (id INTEGER PRIMARY KEY);
+    CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value);
+  ''')
+  old = folder+'/issues.txt'
+  if os.path.isfile(old) and db.execute('SELECT 1 FROM seen LIMIT 1').fetchone() is None:
+    with open(old, 'rt') as f:
+      ids = ast.literal_eval(f.read())
+    with db:
+      db.executemany('INSERT OR IGNORE INTO seen VALUES (?)', [(i,) for i in ids])
+  return db
 
-# read all issues from github
-r = requests.get('https://api.github.com/issues', auth=auth)
-if r.status_code == 200:
-  for issue in r.json():
-    issues[issue['id']] = issue
-if 'link' in r.headers:
-  pages = { rel[6:-1]: url[url.index('<')+1:-1] for url, rel in (link.split(';') for link in r.headers['link'].split(',')) }
-  while 'last' in pages and 'next' in pages:
-    pages = { rel[6:-1]: url[url.index('<')+1:-1] for url, rel in (link.split(';') for link in r.headers['link'].split(',')) }
-    r = requests.get(pages['next'], auth=auth)
-    if r.status_code == 200:
-      for issue in r.json():
-        issues[issue['id']] = issue
-    if pages['next'] == pages['last']:
-      break
+# value from state (None if not set)
+def get_state(db, key):
+  row = db.execute('SELECT value FROM state WHERE key = ?', (key,)).fetchone()
+  return row[0] if row is not None else None
 
-# simulate getting data from github.com
-# for s in open('github.dump', 'rt'):
-#   issue = eval(s)
-#   issues[issue['id']] = issue
-#   print(issue['id'], ':', issue['title'])
-
-# make a list of issues
-iset = set()
-for i in issues.values():
-  iset.add(i['id'])
-
-# create folder to cache issue list
+# create folder to keep state
 try:
   os.mkdir(folder)
 except:
   pass
+db = open_state(folder+'/state.db')
 
-# load old issue list from disk
-oiset = set()
-try:
-  with open(folder+'/issues.txt', 'rt') as f:
-    oiset = eval(f.read())
-except:
-  pass
+# pooled session, with a connection per worker
+session = requests.Session()
+session.auth = auth
+session.mount('https://', HTTPAdapter(pool_connections=1, pool_maxsize=workers))
 
-# go through new issues and make tasks
-for i in iset.difference(oiset):
-  issue = issues[i]
+# issue as a 2Do task item
+def issue_item(issue):
   title = issue['title']
-  url = re.sub(r'\\n', '', issue['html_url'])
-  abbv = url.replace('https://github.com/', '').replace('/issues/', '#')
-  if '/pull/' in url:
+  url2 = re.sub(r'\\n', '', issue['html_url'])
+  abbv = url2.replace('https://github.com/', '').replace('/issues/', '#')
+  if '/pull/' in url2:
     title = 'PR: '+title
     abbv = abbv.replace('/pull/', '#')
-  task = {
-    'task': title,
-    'action': 'url:'+url,
-    'note': abbv,
-    'type': 0,
-    'ignoreDefaults': 1,
-    'edit': 0,
-    'tags': 'github',
-    'forList': 'Inbox'
+  return {
+    'key': issue['id'],
+    'title': title,
+    'list': 'Inbox',
+    'twodo': { 'action': 'url:'+url2, 'note': abbv, 'tags': 'github' }
   }
-  q = urllib.parse.urlencode(task).replace('+', '%20')
-  #print('open \'twodo://x-callback-url/add?' + q + '\'')
-  os.system('open \'twodo://x-callback-url/add?' + q + '\'')
 
-# write latest issue list to disk
-with open(folder+'/issues.txt', 'wt') as f:
-  f.write(str(iset))
+# whether an issue has already been turned into a task
+def known(i):
+  return db.execute('SELECT 1 FROM seen WHERE id = ?', (i,)).fetchone() is not None
+
+# read issues updated since the last change from github
+#   The first page is requested conditionally, so if nothing has changed github
+#   answers 304 Not Modified, and we are done. Other pages are fetched concurrently.
+params = { 'per_page': perPage }
+since = get_state(db, 'since')
+if since is not None:
+  params['since'] = since
+url = api+'/issues?'+urllib.parse.urlencode(params)
+headers = {}
+if get_state(db, 'url') == url and get_state(db, 'etag') is not None:
+  headers['If-None-Match'] = get_state(db, 'etag')
+with metrics.phase('github.first'):
+  r = session.get(url, headers=headers)
+metrics.count('github.first', api_calls=1, bytes_read=len(r.content))
+if r.status_code == 304:
+  exit(0)
+if r.status_code != 200:
+  print(r.status_code, r.text)
+  exit(1)
+
+# simulate getting data from github.com
+# for s in open('github.dump', 'rt'):
+#   issue = eval(s)
+#   issues[issue['id']] = issue
+#   print(issue['id'], ':', issue['title'])
+
+# make tasks for new issues, as pages arrive
+new = []
+failed = 0
+with metrics.phase('tasks'):
+  try:
+    items = dedup(map(issue_item, counted('github', buffered(github_issues(session, r, workers)))), known=known)
+    for item, e in counted('2do', twodo_sink(items)):
+      if e is not None:
+        print(item['twodo']['action'][4:], e)
+        failed += 1
+      else:
+        new.append(item['key'])
+  except RuntimeError as e:
+    print(e)
+    failed += 1
+count = stats.get('github', [0])[0]
+
+# record new issues, and the request to make conditionally next time
+#   If issues were returned, next time we ask for issues updated since this
+#   response (by github's clock). Otherwise the same request is repeated, and its
+#   etag kept, so that it is answered with 304 Not Modified until something changes.
+#   If any task could not be sent, the same request is made again next time.
+with db:
+  db.executemany('INSERT OR IGNORE INTO seen VALUES (?)', [(i,) for i in new])
+  if failed == 0 and count > 0 and 'date' in r.headers:
+    since = email.utils.parsedate_to_datetime(r.headers['date']).strftime('%Y-%m-%dT%H:%M:%SZ')
+    db.execute("INSERT OR REPLACE INTO state VALUES ('since', ?)", (since,))
+    db.execute("DELETE FROM state WHERE key IN ('url', 'etag')")
+  elif failed == 0 and 'etag' in r.headers:
+    db.execute("INSERT OR REPLACE INTO state VALUES ('url', ?)", (url,))
+    db.execute("INSERT OR REPLACE INTO state VALUES ('etag', ?)", (r.headers['etag'],))
+report()
@@ -0,0 +1,369 @@
+# Helpers for Google API clients shared by the productivity scripts
+#
+# All requests go through a shared rate limiter (see RateLimiter), and requests
+# failing with quota (429, 403 rateLimitExceeded) or server (5xx) errors are
+# retried with exponential backoff and jitter.
+
+import os, sys, json, time, random, atexit, threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from googleapiclient.discovery import build, build_from_document
+from httplib2 import Http
+from oauth2client import file, client, tools
+from pathlib import Path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'quiver'))
+import metrics
+
+# settings
+home         = str(Path.home())
+credentials  = home+'/.google/credentials.json'         # Google oauth credentials
+cacheDir     = home+'/.google/cache'                    # cached discovery documents and list ids
+discoveryUrl = 'https://www.googleapis.com/discovery/v1/apis/{api}/{apiVersion}/rest'
+discoveryTTL = 7*24*3600                                # seconds to use a cached discovery document
+listsTTL     = 3600                                     # seconds to use cached task list ids
+timeout      = 60                                       # http timeout in seconds
+startRate    = 10.0                                     # requests per second until a rate has been learned
+maxRate      = 100.0                                    # highest requests per second to speed up to
+minRate      = 0.2                                      # lowest requests per second to slow down to
+rateStep     = 0.5                                      # requests per second to speed up by after each success
+ratesTTL     = 24*3600                                  # seconds to use learned rates in later runs
+maxRetries   = 6                                        # retries of a failing request
+backoffBase  = 1.0                                      # seconds to wait before the first retry
+backoffMax   = 64.0                                     # maximum seconds to wait before a retry
+
+# write a file in the cache folder atomically
+def _cache_write(fname, data):
+  if not os.path.isdir(cacheDir):
+    os.makedirs(cacheDir)
+  with open(fname+'.tmp', 'w', encoding='utf-8') as f:
+    f.write(data)
+  os.replace(fname+'.tmp', fname)
+
+# read a file from the cache folder if it is recent enough
+#   params: filename, maximum age in seconds (None for any age)
+#   returns: file contents, or None if missing or too old
+def _cache_read(fname, ttl):
+  try:
+    if ttl is None or time.time() - os.path.getmtime(fname) < ttl:
+      with open(fname, encoding='utf-8') as f:
+        return f.read()
+  except OSError:
+    pass
+  return None
+
+# adaptive token bucket rate limiter, shared by all threads
+#   Requests take tokens from a bucket that is refilled at rate tokens per second
+#   and holds up to a second's worth. Tokens may be taken ahead of time, and the
+#   caller then waits until they would have been available, so a batch of n
+#   requests is spaced like n single requests. The rate is learned from quota
+#   responses: it is halved on a quota error (at most once a second, as
+#   concurrent requests tend to fail together), and increased by rateStep for
+#   each request that succeeds after having had to wait for tokens (up to
+#   maxRate), so it settles just below the sustainable rate, and does not grow
+#   while requests are sent slower than the rate anyway. The rate of each api
+#   last seen before a quota error (or the final rate, if there was none) is kept
+#   in the cache folder for later runs.
+class RateLimiter(object):
+  def __init__(self, rate=startRate):
+    self.rate = rate
+    self.tokens = 1.0
+    self.stamp = time.time()
+    self.hold = 0.0       # no requests before this time (from Retry-After)
+    self.cut = 0.0        # time the rate was last halved
+    self.waited = False   # whether requests had to wait since the rate was last raised
+    self.learned = None   # rate at the last quota error
+    self.name = None
+    self.lock = threading.Lock()
+
+  # take tokens from the bucket, waiting until they are available
+  #   params: number of requests
+  def acquire(self, n=1):
+    with self.lock:
+      now = time.time()
+      self.tokens = min(max(self.rate, 1.0), self.tokens + (now - self.stamp)*self.rate)
+      self.stamp = now
+      self.tokens -= n
+      wait = max(-self.tokens/self.rate, self.hold - now)
+      if wait > 0:
+        self.waited = True
+    if wait > 0:
+      time.sleep(wait)
+
+  # slow down after a quota error
+  #   params: seconds to send no requests for (e.g. from Retry-After)
+  def throttled(self, wait=0):
+    with self.lock:
+      now = time.time()
+      if now - self.cut >= 1.0:
+        self.learned = self.rate
+        self.rate = max(minRate, self.rate/2)
+        self.cut = now
+      self.tokens = min(self.tokens, 0.0)
+      self.hold = max(self.hold, now + wait)
+    metrics.count('google.throttled', calls=1)
+
+  # speed up after successful requests, if requests have been held back by the rate
+  #   params: number of requests
+  def succeeded(self, n=1):
+    with self.lock:
+      if self.waited:
+        self.rate = max(self.rate, min(maxRate, self.rate + rateStep*n))
+        self.waited = False
+
+  # start from the rate learned for an api in an earlier run, and keep the rate learned in this run
+  #   params: api name
+  def learn(self, name):
+    if self.name is not None:
+      return
+    self.name = name
+    data = _cache_read(os.path.join(cacheDir, 'rates.json'), ratesTTL)
+    rates = json.loads(data) if data is not None else {}
+    if name in rates:
+      self.rate = max(minRate, rates[name])
+    atexit.register(self.save)
+
+  # write the learned rate to the cache folder
+  def save(self):
+    fname = os.path.join(cacheDir, 'rates.json')
+    data = _cache_read(fname, None)
+    rates = json.loads(data) if data is not None else {}
+    rates[self.name] = self.learned if self.learned is not None else self.rate
+    _cache_write(fname, json.dumps(rates))
+
+limiter = RateLimiter()
+
+# error reasons of a failed Google API request (e.g. rateLimitExceeded)
+def _reasons(e):
+  try:
+    content = e.content.decode('utf-8') if isinstance(e.content, bytes) else e.content
+    return set(err.get('reason') for err in json.loads(content)['error'].get('errors', []))
+  except Exception:
+    return set()
+
+# how to handle a failed Google API request
+#   Quota errors (429, or 403 with a rate limit reason) and server errors (5xx)
+#   are retried, as are network errors. Other errors (e.g. 404, or exceeded daily
+#   quotas) are final.
+#   params: exception
+#   returns: None if final, else (whether it is a quota error, seconds to wait at least)
+def retryable(e):
+  resp = getattr(e, 'resp', None)
+  status = getattr(resp, 'status', None)
+  if status is None:
+    return (False, 0) if isinstance(e, OSError) else None
+  status = int(status)
+  try:
+    wait = float(resp.get('retry-after', 0))
+  except (AttributeError, TypeError, ValueError):
+    wait = 0
+  if status == 429 or (status == 403 and len(_reasons(e) & set(['rateLimitExceeded', 'userRateLimitExceeded'])) > 0):
+    return True, wait
+  if status >= 500:
+    return False, wait
+  return None
+
+# seconds to wait before a retry: exponential backoff with jitter
+#   params: number of retries so far, seconds to wait at least
+def backoff(attempt, wait=0):
+  delay = min(backoffMax, backoffBase * 2**attempt)
+  return max(wait, delay/2 + random.uniform(0, delay/2))
+
+# make Google API requests, rate limited and retried on quota and server errors
+#   params: function making the requests (e.g. request.execute), number of requests it makes
+#   returns: result of the function, or raises its exception once it is final or retries are exhausted
+def call(f, cost=1):
+  attempt = 0
+  while True:
+    limiter.acquire(cost)
+    try:
+      result = f()
+    except Exception as e:
+      retry = retryable(e)
+      if retry is None or attempt >= maxRetries:
+        raise
+      if retry[0]:
+        limiter.throttled(retry[1])
+      metrics.count('google.retries', calls=1)
+      time.sleep(backoff(attempt, retry[1]))
+      attempt += 1
+      continue
+    limiter.succeeded(cost)
+    return result
+
+# execute a Google API request, rate limited and retried (see call)
+#   params: request, http object to use (or None for default)
+#   returns: response
+def execute(request, http=None):
+  return call(lambda: request.execute(http=http))
+
+# factory for authorized http objects, one per thread
+#   httplib2 keeps connections alive per http object but is not thread-safe, so
+#   each thread gets its own, which is reused for all requests from that thread.
+#   params: oauth2client credentials
+#   returns: function returning the authorized http object of the calling thread
+def http_factory(creds):
+  local = threading.local()
+  def http():
+    if not hasattr(local, 'http'):
+      local.http = creds.authorize(Http(timeout=timeout))
+    return local.http
+  return http
+
+# Google API discovery document, from the local cache if recent enough
+#   A stale cached document is used if it can not be fetched.
+#   params: api name, api version, http object
+#   returns: discovery document (string), or None if not available
+def discovery_document(api, version, http):
+  fname = os.path.join(cacheDir, api+'-'+version+'.json')
+  doc = _cache_read(fname, discoveryTTL)
+  if doc is not None:
+    return doc
+  try:
+    with metrics.phase('google.discovery'):
+      resp, content = http.request(discoveryUrl.replace('{api}', api).replace('{apiVersion}', version))
+    metrics.count('google.discovery', api_calls=1, bytes_read=len(content))
+    if resp.status == 200:
+      doc = content.decode('utf-8')
+      _cache_write(fname, doc)
+      return doc
+  except Exception as e:
+    print(e)
+  return _cache_read(fname, None)
+
+# authorized Google API client
+#   Runs the oauth flow if there are no valid credentials in the token store,
+#   builds the client from the cached discovery document, and shares one
+#   keep-alive http object per thread for all requests. Requests are rate limited
+#   starting from the rate learned for the api.
+#   params: api name, api version, oauth scope, oauth token store filename
+#   returns: (service, http factory) tuple
+def google_service(api, version, scope, token):
+  store = file.Storage(token)
+  creds = store.get()
+  if not creds or creds.invalid:
+    flow = client.flow_from_clientsecrets(credentials, scope)
+    creds = tools.run_flow(flow, store)
+  http = http_factory(creds)
+  limiter.learn(api)
+  doc = discovery_document(api, version, http())
+  if doc is None:
+    return build(api, version, http=http()), http
+  return build_from_document(doc, http=http()), http
+
+# write the map of task list titles to ids to the cache
+#   params: task lists (dictionaries with id and title)
+#   returns: dictionary of list title to list id
+def _cache_lists(items):
+  lists = {}
+  for item in items:
+    lists[item['title']] = item['id']
+  _cache_write(os.path.join(cacheDir, 'tasklists.json'), json.dumps(lists))
+  return lists
+
+# all Google task lists, refreshing the cached map of list titles to ids
+#   List titles need not be unique, so use this rather than task_lists to go
+#   through every list.
+#   params: tasks service
+#   returns: list of task lists (dictionaries with id and title)
+def all_task_lists(service):
+  items = list(list_all(service.tasklists().list, maxResults=100))
+  _cache_lists(items)
+  return items
+
+# map of Google task list titles to ids, cached for listsTTL seconds
+#   Only one of several lists with the same title is mapped.
+#   params: tasks service, whether to ignore the cache
+#   returns: dictionary of list title to list id
+def task_lists(service, refresh=False):
+  data = None if refresh else _cache_read(os.path.join(cacheDir, 'tasklists.json'), listsTTL)
+  if data is not None:
+    return json.loads(data)
+  return _cache_lists(list_all(service.tasklists().list, maxResults=100))
+
+# execute Google API requests in HTTP batches
+#   Requests are sent in batches of up to size requests, and the result of each
+#   request is mapped back to its position in the list. Batches are rate limited
+#   as that many requests, and hold no more than a second's worth of requests at
+#   the current rate, as the requests of a batch reach the quota all at once.
+#   Requests failing with quota or server errors (each request in a batch can
+#   fail on its own) are sent again in a later batch, after backing off. If a
+#   whole batch fails, the error is reported for each request in it.
+#   params: service, list of requests (not yet executed), batch size
+#   returns: list of (response, exception) tuples, in the same order as the requests
+def batch_execute(service, requests, size=50):
+  results = [None]*len(requests)
+  def callback(rid, response, exception):
+    results[int(rid)] = (response, exception)
+  pending = list(range(len(requests)))
+  attempt = 0
+  while len(pending) > 0:
+    retry = []
+    wait = 0
+    i = 0
+    while i < len(pending):
+      chunk = pending[i:i+min(size, max(1, int(limiter.rate)))]
+      i += len(chunk)
+      batch = service.new_batch_http_request(callback=callback)
+      for j in chunk:
+        batch.add(requests[j], request_id=str(j))
+      metrics.count('google.batch', api_calls=1)
+      metrics.count('google.requests', calls=len(chunk))
+      limiter.acquire(len(chunk))
+      try:
+        with metrics.phase('google.batch'):
+          batch.execute()
+      except Exception as e:
+        for j in chunk:
+          if results[j] is None:
+            results[j] = (None, e)
+      quota = False
+      failed = 0
+      for j in chunk:
+        if results[j] is None:
+          results[j] = (None, RuntimeError('No response to batched request'))
+        if results[j][1] is not None:
+          failed += 1
+          r = retryable(results[j][1])
+          if r is not None and attempt < maxRetries:
+            quota = quota or r[0]
+            wait = max(wait, r[1])
+            results[j] = None
+            retry.append(j)
+      if quota:
+        limiter.throttled(wait)
+      limiter.succeeded(len(chunk) - failed)
+    if len(retry) > 0:
+      metrics.count('google.retries', calls=len(retry))
+      time.sleep(backoff(attempt, wait))
+      attempt += 1
+    pending = retry
+  return results
+
+# list all items from a paginated Google API list method
+#   Each page is requested rate limited and retried (see call).
+#   params: list method (e.g. service.tasks().list), http object to use (or None for default), arguments to method
+#   returns: generator of items, following nextPageToken until all pages are read
+def list_all(method, http=None, **kwargs):
+  while True:
+    with metrics.phase('google.list'):
+      results = execute(method(**kwargs), http)
+    metrics.count('google.list', api_calls=1)
+    for item in results.get('items', []):
+      yield item
+    kwargs['pageToken'] = results.get('nextPageToken')
+    if not kwargs['pageToken']:
+      break
+
+# fetch all tasks from several Google task lists concurrently
+#   Each list is paged through in a worker thread with its own http object (as
+#   httplib2 is not thread-safe), and is yielded as soon as it has been fetched.
+#   params: tasks service, task list ids, function returning a new authorized http object, number of workers, arguments to tasks().list
+#   returns: generator of (task list id, list of tasks)
+def fetch_tasks(service, tlists, http, workers=8, **kwargs):
+  local = threading.local()
+  def fetch(tlist):
+    if not hasattr(local, 'http'):
+      local.http = http()
+    return tlist, list(list_all(service.tasks().list, local.http, tasklist=tlist, maxResults=100, **kwargs))
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    for job in as_completed([pool.submit(fetch, tlist) for tlist in tlists]):
+      yield job.result()
@@ -0,0 +1,224 @@
+# Streaming task pipeline shared by the productivity scripts
+#
+# Tasks flow from a source to a sink through generator stages, one item at a
+# time, as dictionaries with (some of) these keys:
+#   title  task title
+#   due    due date (string, or datetime once normalized)
+#   notes  task notes
+#   list   task list name
+#   key    identity of the item, for dedup
+#   file, note, rule, ...  source specific fields
+#   twodo  extra 2Do x-callback-url parameters
+#
+# Sources: reminders (Apple Reminders), github_issues (GitHub issue pages) and
+# quiver_repeats (Quiver @repeat scan). Quiver @todo items are kept in the note
+# catalog (see quiverlib.todo_refresh).
+# Transforms: dedup, normalize_dates, buffered (bounded read-ahead in a thread).
+# Sinks: gtasks_sink (batched Google task inserts) and twodo_sink (batched,
+# rate-limited 2Do x-callback-urls), which yield the outcome of each item.
+# Each stage can be wrapped with counted, to keep per-stage throughput counters
+# that are printed by report when PIPELINE_STATS is set.
+
+import os, sys, time, threading, queue, urllib.parse
+from concurrent.futures import ThreadPoolExecutor, as_completed
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'quiver'))
+import metrics
+
+# per-stage counters: stage name to [items, seconds from first request to last item]
+stats = {}
+
+# count items passing through a stage
+#   params: stage name, iterable of items
+#   returns: generator of the same items
+def counted(name, items):
+  count = stats.setdefault(name, [0, 0.0])
+  t0 = time.perf_counter()
+  for item in items:
+    count[0] += 1
+    metrics.count('pipeline.'+name, calls=1)
+    count[1] = time.perf_counter() - t0
+    yield item
+
+# print per-stage counters, if the PIPELINE_STATS environment variable is set
+def report(out=sys.stderr):
+  if not os.environ.get('PIPELINE_STATS'):
+    return
+  for name in stats:
+    n, dt = stats[name]
+    out.write('%-20s %8d items %9.3f s %10.1f items/s\n'%(name, n, dt, n/dt if dt > 0 else 0))
+
+# group items into lists of up to size items, as they arrive
+#   returns: generator of lists
+def batches(items, size):
+  batch = []
+  for item in items:
+    batch.append(item)
+    if len(batch) >= size:
+      yield batch
+      batch = []
+  if len(batch) > 0:
+    yield batch
+
+# read items ahead in a thread, holding at most size items in flight
+#   Lets a slow source (e.g. network fetches) overlap with a slow sink.
+#   returns: generator of the same items
+def buffered(items, size=100):
+  q = queue.Queue(maxsize=size)
+  done = object()
+  def run():
+    try:
+      for item in items:
+        q.put((item, None))
+    except Exception as e:
+      q.put((None, e))
+    q.put((done, None))
+  threading.Thread(target=run, daemon=True).start()
+  while True:
+    item, e = q.get()
+    if e is not None:
+      raise e
+    if item is done:
+      break
+    yield item
+
+# drop items whose key was already seen in this run, or is known from a previous run
+#   params: items, function returning the key of an item, function telling whether a key is already known
+#   returns: generator of new items
+def dedup(items, key=lambda item: item['key'], known=None):
+  seen = set()
+  for item in items:
+    k = key(item)
+    if k in seen or (known is not None and known(k)):
+      continue
+    seen.add(k)
+    yield item
+
+# parse due dates given as strings, in all kinds of formats
+#   Unparseable dates are dropped.
+#   returns: generator of items with due as datetime (or None)
+def normalize_dates(items):
+  import dateutil.parser
+  for item in items:
+    due = item.get('due')
+    if isinstance(due, str):
+      try:
+        item['due'] = dateutil.parser.parse(due)
+      except (ValueError, OverflowError):
+        item['due'] = None
+    yield item
+
+# reminders from a list in Apple Reminders, deleting them from Reminders
+#   params: Apple Reminders list name
+#   returns: generator of items (title, due)
+def reminders(inbox):
+  from subprocess import Popen, PIPE
+  scpt = '''
+    set out to ""
+    tell application "Reminders"
+      set mylist to (every reminder in list "#INBOX#" whose completed is false)
+      repeat with r in mylist
+        set out to out & (name of r as string) & "|" & (due date of r as string) & "
+"
+        delete r
+      end repeat
+    end tell
+    return out
+  '''.replace('#INBOX#', inbox)
+  p = Popen(['osascript'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
+  stdout, stderr = p.communicate(scpt.encode('utf-8'))
+  out = stdout.decode('utf-8')
+  if p.returncode != 0:
+    raise RuntimeError('osascript failed (%d): %s %s'%(p.returncode, out, stderr.decode('utf-8')))
+  for line in out.splitlines():
+    if '|' in line:
+      title, due = line.split('|', 1)
+      yield { 'title': title, 'due': None if due == 'missing value' else due }
+
+# GitHub issues from a paginated /issues response
+#   Issues of the first page are yielded first, then the remaining pages (known
+#   from the Link header) are fetched concurrently, and yielded as they arrive.
+#   params: requests session, first page response, number of workers
+#   returns: generator of issues (dictionaries as returned by GitHub)
+def github_issues(session, first, workers=4):
+  for issue in first.json():
+    yield issue
+  pages = {}
+  if 'link' in first.headers:
+    pages = { rel.strip()[5:-1]: url.strip()[1:-1] for url, rel in (link.split(';') for link in first.headers['link'].split(',')) }
+  if 'last' not in pages:
+    return
+  u = urllib.parse.urlparse(pages['last'])
+  q = urllib.parse.parse_qs(u.query)
+  urls = []
+  for page in range(2, int(q['page'][0])+1):
+    q['page'] = [str(page)]
+    urls.append(urllib.parse.urlunparse(u._replace(query=urllib.parse.urlencode(q, doseq=True))))
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    for job in as_completed([pool.submit(session.get, url) for url in urls]):
+      r = job.result()
+      metrics.count('github.pages', api_calls=1, bytes_read=len(r.content))
+      if r.status_code != 200:
+        raise RuntimeError('GitHub error %d: %s'%(r.status_code, r.text))
+      for issue in r.json():
+        yield issue
+
+# Quiver @repeat rules of notes
+#   params: iterable of quiverlib Notes
+#   returns: generator of items (file, note, title, rule, params)
+def quiver_repeats(notes):
+  for note in notes:
+    for tagged in note.inline_tags():
+      repeat = tagged.tags.get('repeat')
+      if repeat is not None and repeat.args is not None:
+        yield { 'file': note.filename, 'note': note.title, 'title': repeat.title, 'rule': repeat.args, 'params': repeat.params }
+
+# Google task body of an item
+def gtask_body(item):
+  import pytz
+  body = {
+    'status': 'needsAction',
+    'kind': 'tasks#task',
+    'title': item['title'],
+  }
+  if item.get('notes') is not None:
+    body['notes'] = item['notes']
+  if item.get('due') is not None:
+    body['due'] = item['due'].astimezone(pytz.utc).isoformat('T')
+  return body
+
+# create Google tasks for items, in batches as items arrive
+#   The handled function is called once the outcomes of a batch have been taken,
+#   before the next batch is sent, e.g. to commit what was recorded about them.
+#   params: tasks service, items (with due normalized), task list id (or function returning the list id of an item), batch size, function to call after each batch
+#   returns: generator of (item, response, exception) tuples, in the same order as the items
+def gtasks_sink(service, items, tasklist, size=50, handled=None):
+  from googlelib import batch_execute
+  for batch in batches(items, size):
+    requests = [service.tasks().insert(tasklist=tasklist(item) if callable(tasklist) else tasklist, body=gtask_body(item)) for item in batch]
+    for item, (response, e) in zip(batch, batch_execute(service, requests, size)):
+      yield item, response, e
+    if handled is not None:
+      handled()
+
+# 2Do task parameters of an item
+def twodo_task(item):
+  task = {
+    'task': item['title'],
+    'type': 0,
+    'ignoreDefaults': 1,
+    'edit': 0,
+    'forList': item.get('list', 'Inbox')
+  }
+  if item.get('due') is not None:
+    task['due'] = item['due'].strftime('%Y-%m-%d')
+  task.update(item.get('twodo', {}))
+  return task
+
+# send items to 2Do, in rate-limited batches as items arrive
+#   params: items (with due normalized), 2Do sink (see twodolib.sink_function, None for the default), number of items per dispatch
+#   returns: generator of (item, exception) tuples, in the same order as the items
+def twodo_sink(items, sink=None, size=50):
+  from twodolib import add_url, dispatch
+  for batch in batches(items, size):
+    for item, e in zip(batch, dispatch([add_url(twodo_task(item)) for item in batch], sink)):
+      yield item, e
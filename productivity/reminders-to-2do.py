@@ -6,55 +6,22 @@
 # primarily to facilitate use of Siri to add reminders to 2Do tasks, and
 # Siri does not typically populate other reminder fields.
 
-from subprocess import Popen, PIPE
-import dateutil.parser, urllib.parse, re, os
+from pipeline import reminders, normalize_dates, twodo_sink, counted, report
+import metrics
 
 # settings
 inbox        = 'Inbox'                            # Apple Reminders list to copy from
 
-# Applescript to get reminders from Apple Reminders and delete them
-scpt = '''
-  set out to ""
-  tell application "Reminders"
-    set mylist to (every reminder in list "#INBOX#" whose completed is false)
-    repeat with r in mylist
-      set out to out & (name of r as string) & "|" & (due date of r as string) & "
-"
-      delete r
-    end repeat
-  end tell
-  return out
-'''.replace('#INBOX#', inbox)
-
-# run apple script and capture output
-p = Popen(['osascript'], stdin=PIPE, stdout=PIPE, stderr=PIPE)
-stdout, stderr = p.communicate(scpt.encode('utf-8'))
-out = stdout.decode('utf-8')
-if p.returncode != 0:
-  err = stderr.decode('utf-8')
-  print(p.returncode, out, err)
+# move reminders to 2Do tasks
+metrics.start('reminders-to-2do')
+try:
+  with metrics.phase('move'):
+    items = normalize_dates(counted('reminders', reminders(inbox)))
+    for item, e in counted('2do', twodo_sink(items)):
+      if e is not None:
+        print(item['title'])
+        print(e)
+except RuntimeError as e:
+  print(e)
   exit(1)
-tasks = []
-for line in out.splitlines():
-  if '|' in line:
-    title, due = line.split('|')
-    if due == 'missing value':
-      due = None
-    else:
-      due = dateutil.parser.parse(due)
-    tasks.append((title, due))
-
-# create 2Do tasks
-for rtask in tasks:
-  task = {
-    'task': rtask[0],
-    'type': 0,
-    'ignoreDefaults': 1,
-    'edit': 0,
-    'forList': 'Inbox'
-  }
-  if rtask[1] is not None:
-    task['due'] = rtask[1].strftime('%Y-%m-%d')
-  q = urllib.parse.urlencode(task).replace('+', '%20')
-  #print('open \'twodo://x-callback-url/add?' + q + '\'')
-  os.system('open \'twodo://x-callback-url/add?' + q + '\'')
+report()
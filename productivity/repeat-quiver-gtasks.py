@@ -8,99 +8,161 @@
 #   - Do something urgent every Tuesday @repeat(weekday=1, due=+1)
 #   - Do something every month @repeat(day=1)
 #   - Do something every year @repeat(month=2, day=14)
+#
+# The @repeat rules are kept in a schedule index, refreshed only for notes that
+# have changed, together with the occurrences already created. Days missed since
+# the last run (up to catchup days) are caught up, and running more than once a
+# day does not create duplicate tasks.
 
-import os, json, re, datetime, pytz
-from googleapiclient.discovery import build
-from httplib2 import Http
-from oauth2client import file, client, tools
+import os, sys, sqlite3, datetime
 from pathlib import Path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'quiver'))
+from quiverlib import Library, catalog_open
+from googlelib import google_service, task_lists
+from pipeline import quiver_repeats, gtasks_sink, counted, report
+import metrics
 
 # settings
 home         = str(Path.home())
 quiverRoot   = home+'/Dropbox/apps/Quiver.qvlibrary'    # Quiver notebook path
-store        = home+'/.google/token-tasks.json'         # Google oauth credentials
-credentials  = home+'/.google/credentials.json'         # Google oauth credentials
+store        = home+'/.google/token-tasks.json'         # Google oauth token
 inbox        = 'Inbox'                                  # default list for repeated tasks
 trash        = 'Trash.qvnotebook'                       # Quiver trash notebook to ignore
+catalogFile  = home+'/.quiver/catalog.db'               # local Quiver note catalog
+scheduleFile = home+'/.quiver/repeat.db'                # @repeat schedule index
+catchup      = 7                                        # maximum number of missed days to catch up on
 
 # authenticate Google task API
-store = file.Storage(store)
-creds = store.get()
-if not creds or creds.invalid:
-  flow = client.flow_from_clientsecrets(credentials, 'https://www.googleapis.com/auth/tasks')
-  creds = tools.run_flow(flow, store)
-service = build('tasks', 'v1', http=creds.authorize(Http()))
+metrics.start('repeat-quiver-gtasks')
+service, http = google_service('tasks', 'v1', 'https://www.googleapis.com/auth/tasks', store)
+
+# open @repeat schedule index
+def open_schedule(fname):
+  folder = os.path.dirname(fname)
+  if not os.path.isdir(folder):
+    os.makedirs(folder)
+  db = sqlite3.connect(fname)
+  db.executescript('''
+    CREATE TABLE IF NOT EXISTS notes (file TEXT PRIMARY KEY, mtime REAL, size INTEGER);
+    CREATE TABLE IF NOT EXISTS rules (file TEXT, title TEXT, rule TEXT, weekday REAL, day REAL, month REAL, due REAL, list TEXT);
+    CREATE INDEX IF NOT EXISTS rules_file ON rules (file);
+    CREATE TABLE IF NOT EXISTS created (date TEXT, file TEXT, title TEXT, rule TEXT, id TEXT, PRIMARY KEY (date, file, title, rule));
+    CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value);
+  ''')
+  return db
+
+# parse a @repeat rule
+#   params: (key, value) pairs of rule
+#   returns: (weekday, day, month, due days, list name) tuple (None if not specified)
+def parse_rule(params):
+  rule = { 'weekday': None, 'day': None, 'month': None, 'due': None, 'list': inbox }
+  for key, value in params:
+    if key != 'list':
+      try:
+        v = float(value)
+      except:
+        print('Bad value:', key+'='+value)
+        v = 0
+    if key in ('weekday', 'day', 'month', 'due'):
+      rule[key] = v
+    elif key == 'list':
+      rule[key] = value
+    else:
+      print('Bad keyword:', key+'='+value)
+  return (rule['weekday'], rule['day'], rule['month'], rule['due'], rule['list'])
+
+# bring the @repeat rules of changed Quiver notes up to date
+#   params: sqlite3 connection, Quiver library
+#   returns: number of notes re-scanned
+@metrics.timed('refresh')
+def refresh_schedule(db, library):
+  known = dict((r[0], r[1:]) for r in db.execute('SELECT file, mtime, size FROM notes'))
+  changed = []
+  for note in library.notes():
+    old = known.pop(note.filename, None)
+    try:
+      st = os.stat(note.filename)
+    except OSError:
+      continue
+    if old != (st.st_mtime, st.st_size):
+      changed.append((note, st))
+  with db:
+    for note, st in changed:
+      db.execute('DELETE FROM rules WHERE file = ?', (note.filename,))
+      db.execute('INSERT OR REPLACE INTO notes VALUES (?, ?, ?)', (note.filename, st.st_mtime, st.st_size))
+    db.executemany('INSERT INTO rules VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+      ((r['file'], r['title'], r['rule'])+parse_rule(r['params']) for r in counted('quiver', quiver_repeats(c[0] for c in changed))))
+    for filename in known:
+      db.execute('DELETE FROM rules WHERE file = ?', (filename,))
+      db.execute('DELETE FROM notes WHERE file = ?', (filename,))
+  return len(changed)
+
+# occurrences of @repeat rules due on a date that have not been created yet
+#   params: sqlite3 connection, date
+#   returns: generator of items (date, file, title, rule, due datetime, list name)
+def due_on(db, date):
+  day = datetime.datetime.combine(date, datetime.datetime.min.time())
+  for filename, title, rule, due, tlist in db.execute('''
+    SELECT r.file, r.title, r.rule, r.due, r.list FROM rules r
+    WHERE (r.weekday IS NULL OR r.weekday = ?) AND (r.day IS NULL OR r.day = ?) AND (r.month IS NULL OR r.month = ?)
+      AND NOT EXISTS (SELECT 1 FROM created c WHERE c.date = ? AND c.file = r.file AND c.title = r.title AND c.rule = r.rule)
+  ''', (date.isoweekday(), date.day, date.month, date.isoformat())).fetchall():
+    yield {
+      'date': date,
+      'file': filename,
+      'title': title,
+      'rule': rule,
+      'due': day + datetime.timedelta(days=due) if due is not None else None,
+      'list': tlist
+    }
+
+# occurrences due on days from first to last
+def occurrences(db, first, last):
+  date = first
+  while date <= last:
+    for item in due_on(db, date):
+      yield item
+    date += datetime.timedelta(days=1)
+
+# refresh schedule index
+schedule = open_schedule(scheduleFile)
+refresh_schedule(schedule, Library(quiverRoot, trash, catalog_open(catalogFile)))
 
-# extract tasks from Quiver database
-tasks = []
-regex = re.compile(r'\b(\w+)\b\s*=\s*([\-\+\.0-9a-zA-Z]+)')
-today = datetime.datetime.combine(datetime.date.today(), datetime.datetime.min.time())
-for root, subdirs, files in os.walk(quiverRoot):
-  if trash in root:
-    continue
-  if 'content.json' in files:
-    filename = os.path.join(root, 'content.json')
-    with open(filename, encoding='utf-8') as f:
-      data = json.load(f)
-    t = []
-    for cell in data['cells']:
-      if cell['type'] == 'markdown':
-        for line in cell['data'].splitlines():
-          if re.search(r'\s@repeat\(.*\)', line):
-            m = re.match(r'^[\-\*]?(.*)\s@repeat\(([^\)]*)\).*$', line.strip())
-            title = m[1].strip()
-            criteria = m[2].strip()
-            due = None
-            matches = True
-            tlist = inbox
-            for m in regex.finditer(criteria):
-              if m[1] != 'list':
-                try:
-                  v = float(m[2])
-                except:
-                  print('Bad value:', m[1]+'='+m[2])
-                  v = 0
-              if m[1] == 'weekday':
-                if today.isoweekday() != v:
-                  matches = False
-              elif m[1] == 'day':
-                if today.day != v:
-                  matches = False
-              elif m[1] == 'month':
-                if today.month != v:
-                  matches = False
-              elif m[1] == 'due':
-                due = today + datetime.timedelta(days=v)
-              elif m[1] == 'list':
-                tlist = m[2]
-              else:
-                print('Bad keyword:', m[1]+'='+m[2])
-            if matches:
-              tasks.append((title, due, tlist))
+# days to schedule: today, and days missed since the last run
+today = datetime.date.today()
+row = schedule.execute("SELECT value FROM state WHERE key = 'lastrun'").fetchone()
+first = today
+if row is not None:
+  first = max(datetime.date.fromisoformat(row[0]) + datetime.timedelta(days=1), today - datetime.timedelta(days=catchup))
+  first = min(first, today)
 
-# get Google list ids
-results = service.tasklists().list().execute()
-items = results.get('items', [])
-lists = {}
-for item in items:
-  lists[item['title']] = item['id']
+# Google list id of an item, refreshing cached list ids once if the list is not known
+lists = { 'ids': task_lists(service), 'refreshed': False }
+def list_id(item):
+  if item['list'] not in lists['ids'] and not lists['refreshed']:
+    lists['ids'] = task_lists(service, refresh=True)
+    lists['refreshed'] = True
+  if item['list'] in lists['ids']:
+    return lists['ids'][item['list']]
+  print('Bad list:', item['list'])
+  return lists['ids'][inbox] if inbox in lists['ids'] else list(lists['ids'].values())[0]
 
-# create Google tasks
-for task in tasks:
-  body = {
-    'status': 'needsAction',
-    'kind': 'tasks#task',
-    'title': task[0],
-  }
-  if task[1] is not None:
-    body['due'] = task[1].astimezone(pytz.utc).isoformat('T')
-  try:
-    if task[2] in lists:
-      tlist = lists[task[2]]
+# create Google tasks, recording created occurrences
+#   Created occurrences are committed after each batch, so they are not created
+#   again if the run is interrupted. If a task could not be created, the last run
+#   is recorded as the day before it was due, so the next run tries again from
+#   that day (created occurrences are not created twice).
+lastrun = today
+with metrics.phase('create'):
+  items = counted('occurrences', occurrences(schedule, first, today))
+  for item, result, e in counted('gtasks', gtasks_sink(service, items, list_id, handled=schedule.commit)):
+    if e is not None:
+      print(item)
+      print(e)
+      lastrun = min(lastrun, item['date'] - datetime.timedelta(days=1))
     else:
-      print('Bad list:', task[2])
-      tlist = lists[inbox] if inbox in lists else list(lists.values())[0]
-    service.tasks().insert(tasklist=tlist, body=body).execute()
-  except Exception as e:
-    print(body)
-    print(e)
+      schedule.execute('INSERT OR REPLACE INTO created VALUES (?, ?, ?, ?, ?)', (item['date'].isoformat(), item['file'], item['title'], item['rule'], result['id']))
+with schedule:
+  schedule.execute("INSERT OR REPLACE INTO state VALUES ('lastrun', ?)", (lastrun.isoformat(),))
+  schedule.execute('DELETE FROM created WHERE date < ?', ((today - datetime.timedelta(days=catchup)).isoformat(),))
+report()
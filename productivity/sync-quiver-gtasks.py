@@ -7,212 +7,237 @@
 # are ignored. If a @due(...) tag is present after the @todo tag, we also
 # capture the due date. Deletions, completions and movements between lists in
 # Google tasks are synced back. Completed tasks are marked as @done(...), while
-# deleted tasks are marked as @canceled.
+# deleted tasks are marked as @canceled. These edits are collected and written
+# back with a single update of each affected Quiver document. Tasks are created
+# and deleted in Google tasks using batched, rate limited requests; todos whose
+# task could not be created, and tasks that could not be deleted, are retried in
+# the next run.
+#
+# The synchronization state is kept per machine (in ~/.quiver), not in the
+# Dropbox-synced library, so run this script on one machine only: another
+# machine would not know which todos already have Google tasks, and would create
+# them again.
 
-import os, json, re, pytz, datetime
-import dateutil.parser
-from googleapiclient.discovery import build
-from httplib2 import Http
-from oauth2client import file, client, tools
+import os, sys, json, re, time, sqlite3, pytz, datetime
 from pathlib import Path
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'quiver'))
+from quiverlib import catalog_open, catalog_refresh, todo_refresh, catalog_todos, inline_tags, todo_item
+from pipeline import normalize_dates, gtasks_sink, counted, report
+from googlelib import google_service, all_task_lists, batch_execute, fetch_tasks
+import metrics
 
 # settings
 home         = str(Path.home())
 quiverRoot   = home+'/Dropbox/apps/Quiver.qvlibrary'    # Quiver notebook path
-cachefile    = quiverRoot+'/tasksync.json'              # Synchronization cache file
-store        = home+'/.google/token-tasks.json'         # Google oauth credentials
-credentials  = home+'/.google/credentials.json'         # Google oauth credentials
+statefile    = home+'/.quiver/tasksync.db'              # Synchronization state
+cachefile    = quiverRoot+'/tasksync.json'              # Old synchronization cache (imported into state)
+store        = home+'/.google/token-tasks.json'         # Google oauth token
 activelist   = 'Inbox'                                  # Google task list to create tasks in
 trash        = 'Trash.qvnotebook'                       # Quiver trash notebook to ignore
+catalogFile  = home+'/.quiver/catalog.db'               # local Quiver note catalog
 
 # authenticate Google task API
-store = file.Storage(store)
-creds = store.get()
-if not creds or creds.invalid:
-  flow = client.flow_from_clientsecrets(credentials, 'https://www.googleapis.com/auth/tasks')
-  creds = tools.run_flow(flow, store)
-service = build('tasks', 'v1', http=creds.authorize(Http()))
-
-# parse dates in all kinds of formats
-def parse_date(due):
-  try:
-    return dateutil.parser.parse(due)
-  except:
-    return None
-
-# delete a Google task
-def delete_task(task):
-  tlist, tid = task['id'].split('/')
-  try:
-    results = service.tasks().delete(tasklist=tlist, task=tid).execute()
-  except Exception as e:
-    print(e)
-
-# create new Google tasks
-def create_task(task):
-  due = None
-  if task['due'] is not None:
-    due = parse_date(task['due'])
-  body = {
-    'status': 'needsAction',
-    'kind': 'tasks#task',
-    'title': task['title'],
-    'notes': '[ '+task['note']+' ]'
-  }
-  if due is not None:
-    body['due'] = due.astimezone(pytz.utc).isoformat('T')
-  try:
-    results = service.tasks().insert(tasklist=activelist, body=body).execute()
-    return activelist+'/'+results['id']
-  except Exception as e:
-    print(e)
-    return None
-
-# populate id in task if task exists in tlist, and remove from tlist
-def find_task(tlist, task):
-  for t in tlist:
-    if 'id' in t:
-      task['id'] = t['id']
-      if t == task:
-        tlist.remove(t)
-        return
-      del task['id']
+metrics.start('sync-quiver-gtasks')
+service, http = google_service('tasks', 'v1', 'https://www.googleapis.com/auth/tasks', store)
+
+# request to delete a Google task
+def delete_task(tid):
+  tlist, tid = tid.split('/')
+  return service.tasks().delete(tasklist=tlist, task=tid)
+
+# open synchronization state, importing the old synchronization cache if necessary
+#   The state holds one row per Quiver todo, indexed by Google task id and by
+#   Quiver document, so each run only touches rows for documents and tasks that
+#   have changed.
+def open_state(fname):
+  folder = os.path.dirname(fname)
+  if not os.path.isdir(folder):
+    os.makedirs(folder)
+  db = sqlite3.connect(fname)
+  db.executescript('''
+    CREATE TABLE IF NOT EXISTS tasks (file TEXT, note TEXT, title TEXT, due TEXT, id TEXT);
+    CREATE INDEX IF NOT EXISTS tasks_file ON tasks (file, title);
+    CREATE INDEX IF NOT EXISTS tasks_id ON tasks (id);
+    CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value);
+  ''')
+  if db.execute("SELECT 1 FROM state WHERE key = 'lastrun'").fetchone() is None and os.path.isfile(cachefile):
+    with open(cachefile, encoding='utf-8') as f:
+      cached = json.load(f)
+    with db:
+      for file in cached:
+        db.executemany('INSERT INTO tasks VALUES (?, ?, ?, ?, ?)',
+          [(file, t['note'], t['title'], t['due'], t.get('id')) for t in cached[file]])
+      db.execute("INSERT INTO state VALUES ('lastrun', ?)", (os.path.getmtime(cachefile),))
+  return db
 
 # change task id in database
-def update_tid(db, old, new):
-  for file in db:
-    for item in db[file]:
-      if 'id' in item and item['id'] == old:
-        item['id'] = new
+def update_tid(old, new):
+  state.execute('UPDATE tasks SET id = ? WHERE id = ?', (new, old))
 
-# remove todo markup in Quiver markdown documents
+# queue removal of todo markup in Quiver markdown documents
 def remove_todo(tid, done):
-  global qtodo
-  qtodo2 = {}
-  for file in qtodo:
-    items = []
-    for item in qtodo[file]:
-      if 'id' in item and item['id'] == tid:
-        with open(file, encoding='utf-8') as f:
-          data = json.load(f)
-        for cell in data['cells']:
-          if cell['type'] == 'markdown':
-            lines = cell['data'].splitlines()
-            i = 0
-            for line in lines:
-              if re.search(r'\s@todo\s', line+' '):
-                title = re.match(r'^[\-\*]?(.*)\s@todo\s.*$', line.strip()+' ')[1].strip()
-                if re.match(r'^\[.\]', title):
-                  title = title[3:].strip()
-                if title == item['title']:
-                  if not done:
-                    line = re.sub(r'\s@todo\s', ' @canceled ', line+' ').rstrip()
-                  else:
-                    line = re.sub(r'\s@todo\s', ' @done('+done+') ', line+' ').rstrip()
-                    line = line.replace('- [ ] ', '- [x] ')
-                  lines[i] = line
-              i = i+1
-            cell['data'] = '\n'.join(lines)
-        with open(file, 'w', encoding='utf-8') as f:
-          json.dump(data, f)
-      else:
-        items.append(item)
-    if len(items) > 0:
-      qtodo2[file] = items
-  qtodo = qtodo2
-
-# read synchronization cache
-qtodo_cached = {}
-lastrun = 0
-if os.path.isfile(cachefile):
-  lastrun = mtime = os.path.getmtime(cachefile)
-  with open(cachefile, encoding='utf-8') as f:
-    qtodo_cached = json.load(f)
-
-# extract tasks from Quiver database
-qtodo = {}
-for root, subdirs, files in os.walk(quiverRoot):
-  if trash in root:
-    continue
-  if 'content.json' in files:
-    filename = os.path.join(root, 'content.json')
-    mtime = os.path.getmtime(filename)
-    if mtime < lastrun:
-      if filename in qtodo_cached:
-        qtodo[filename] = qtodo_cached[filename]
-        del qtodo_cached[filename]
-    else:
-      with open(filename, encoding='utf-8') as f:
-        data = json.load(f)
-      t = []
-      for cell in data['cells']:
-        if cell['type'] == 'markdown':
-          for line in cell['data'].splitlines():
-            if re.search(r'\s@todo\s', line+' '):
-              title = re.match(r'^[\-\*]?(.*)\s@todo\s.*$', line.strip()+' ')[1].strip()
-              if re.match(r'^\[.\]', title):
-                title = title[3:].strip()
-              due = re.search(r'\s@due\(([^\)]+)\)', line)
-              if due is not None:
-                due = due[1]
-              task = { 'note': data['title'], 'title': title, 'due': due }
-              if filename in qtodo_cached:
-                find_task(qtodo_cached[filename], task)
-              t.append(task)
-      if len(t) > 0:
-        qtodo[filename] = t
+  for file, title in state.execute('SELECT file, title FROM tasks WHERE id = ?', (tid,)):
+    edits.setdefault(file, {})[title] = done
+    removed.add(tid)
+
+# apply queued todo markup changes, reading and writing each Quiver document once
+@metrics.timed('writeback')
+def apply_todo_edits():
+  for file in edits:
+    with open(file, 'rb') as f:
+      data = f.read()
+    metrics.count('writeback', bytes_read=len(data))
+    data = json.loads(data.decode('utf-8'))
+    changed = False
+    cells = data['cells']
+    for tagged in inline_tags(cells):
+      todo = todo_item(tagged.tags)
+      if todo is not None and todo[0] in edits[file]:
+        done = edits[file][todo[0]]
+        lines = cells[tagged.cell]['data'].splitlines()
+        line = lines[tagged.line]
+        if not done:
+          line = re.sub(r'\s@todo\s', ' @canceled ', line+' ').rstrip()
+        else:
+          line = re.sub(r'\s@todo\s', ' @done('+done+') ', line+' ').rstrip()
+          line = line.replace('- [ ] ', '- [x] ')
+        if line != lines[tagged.line]:
+          lines[tagged.line] = line
+          cells[tagged.cell]['data'] = '\n'.join(lines)
+          changed = True
+    if changed:
+      data = json.dumps(data).encode('utf-8')
+      with open(file+'.tmp', 'wb') as f:
+        f.write(data)
+      os.replace(file+'.tmp', file)
+      metrics.count('writeback', bytes_written=len(data))
+  with state:
+    state.executemany('DELETE FROM tasks WHERE id = ?', [(tid,) for tid in removed])
+  edits.clear()
+  removed.clear()
+
+# read synchronization state
+state = open_state(statefile)
+row = state.execute("SELECT value FROM state WHERE key = 'lastrun'").fetchone()
+lastrun = row[0] if row is not None else 0
+thisrun = time.time()
+
+# extract tasks from changed Quiver documents, keeping Google task ids of unchanged todos
+#   Todos are read from the note catalog, where quiver.py watch keeps them up to
+#   date (otherwise only notes whose content.json has changed are re-scanned),
+#   and only documents whose todos differ from the synchronization state are
+#   updated. Documents of notes whose meta.json or content.json can not be read
+#   (e.g. while Dropbox is syncing them) are left as they are. Google tasks of
+#   removed todos are recorded as stale in the same transaction, together with
+#   deletions that failed in earlier runs, so they are deleted even if this run
+#   does not get that far.
+row = state.execute("SELECT value FROM state WHERE key = 'stale'").fetchone()
+stale = json.loads(row[0]) if row is not None else []
+with metrics.phase('walk'):
+  catalog = catalog_open(catalogFile)
+  catalog_refresh(catalog, quiverRoot, trash)
+  todo_refresh(catalog)
+  todos = catalog_todos(catalog)
+#   Google task ids are matched by document, todo title and due date, but not by
+#   note title, which rows imported from tasksync.json took from content.json
+#   rather than meta.json.
+ids = {}
+def keep_id(key):
+  k = (key[0], key[2], key[3])
+  return key + (ids[k].pop(0) if len(ids.get(k, [])) > 0 else None,)
+with state, metrics.phase('extract'):
+  synced = {}
+  for row in state.execute('SELECT file, note, title, due, id FROM tasks ORDER BY rowid'):
+    synced.setdefault(row[0], []).append(row)
+  for filename in todos:
+    note, items = todos[filename]
+    if note is None or items is None:
+      continue
+    rows = synced.get(filename, [])
+    keys = [(filename, note, title, due) for title, due in items]
+    if [r[:4] for r in rows] == keys:
+      continue
+    for r in rows:
+      if r[4] is not None:
+        ids.setdefault((r[0], r[2], r[3]), []).append(r[4])
+    state.execute('DELETE FROM tasks WHERE file = ?', (filename,))
+    state.executemany('INSERT INTO tasks VALUES (?, ?, ?, ?, ?)', map(keep_id, counted('quiver', keys)))
+  for key in ids:
+    stale += ids[key]
+  for filename in synced:
+    if filename not in todos:
+      stale += [r[4] for r in synced[filename] if r[4] is not None]
+      state.execute('DELETE FROM tasks WHERE file = ?', (filename,))
+  state.execute("INSERT OR REPLACE INTO state VALUES ('stale', ?)", (json.dumps(stale),))
+
+# queued todo markup changes
+edits = {}
+removed = set()
 
 # get Google tasks
 after = datetime.datetime.fromtimestamp(int(lastrun)).astimezone(pytz.utc).isoformat('T')
 gtask_added = {}
 gtask_deleted = {}
 gtask_moved = {}
-results = service.tasklists().list().execute()
-items = results.get('items', [])
-for item in items:
-  if item['title'] == activelist:
-    activelist = item['id']
-  results = service.tasks().list(tasklist=item['id'], showCompleted=True, showDeleted=True, updatedMin=after).execute()
-  items2 = results.get('items', [])
-  for item2 in items2:
-    if 'deleted' in item2 and item2['deleted']:
-      if item2['title'] in gtask_added:
-        gtask_moved[item['id']+'/'+item2['id']] = gtask_added[item2['title']]
-        del gtask_added[item2['title']]
+tlists = all_task_lists(service)
+lists = dict((t['title'], t['id']) for t in tlists)
+if activelist in lists:
+  activelist = lists[activelist]
+with metrics.phase('fetch'):
+  tasks = fetch_tasks(service, [t['id'] for t in tlists], http,
+    showCompleted=True, showDeleted=True, updatedMin=after)
+  for tlist, items2 in tasks:
+    for item2 in items2:
+      if 'deleted' in item2 and item2['deleted']:
+        if item2['title'] in gtask_added:
+          gtask_moved[tlist+'/'+item2['id']] = gtask_added[item2['title']]
+          del gtask_added[item2['title']]
+        else:
+          gtask_deleted[item2['title']] = tlist+'/'+item2['id']
+      elif 'completed' in item2 and item2['completed']:
+        remove_todo(tlist+'/'+item2['id'], item2['completed'][:10])
       else:
-        gtask_deleted[item2['title']] = item['id']+'/'+item2['id']
-    elif 'completed' in item2 and item2['completed']:
-      remove_todo(item['id']+'/'+item2['id'], item2['completed'][:10])
-    else:
-      if item2['title'] in gtask_deleted:
-        gtask_moved[gtask_deleted[item2['title']]] = item['id']+'/'+item2['id']
-        del gtask_deleted[item2['title']]
-      else:
-        gtask_added[item2['title']] = item['id']+'/'+item2['id']
+        if item2['title'] in gtask_deleted:
+          gtask_moved[gtask_deleted[item2['title']]] = tlist+'/'+item2['id']
+          del gtask_deleted[item2['title']]
+        else:
+          gtask_added[item2['title']] = tlist+'/'+item2['id']
 
 # rename moved Google tasks in synchronization database
-for item in gtask_moved:
-  update_tid(qtodo, item, gtask_moved[item])
-  update_tid(qtodo_cached, item, gtask_moved[item])
+with state:
+  for item in gtask_moved:
+    update_tid(item, gtask_moved[item])
+stale = [gtask_moved.get(tid, tid) for tid in stale]
 
 # update Google task deletions in Quiver notebook
 for item in gtask_deleted:
   remove_todo(gtask_deleted[item], False)
 
-# remove deleted Quiver todos from Google tasks
-for file in qtodo_cached:
-  for task in qtodo_cached[file]:
-    if 'id' in task:
-      delete_task(task)
-
-# create new Google tasks for new Quiver todos
-for file in qtodo:
-  for task in qtodo[file]:
-    if 'id' not in task:
-      tid = create_task(task)
-      if tid is not None:
-        task['id'] = tid
-
-# write synzhronization cache
-with open(cachefile, 'w', encoding='utf-8') as f:
-  json.dump(qtodo, f)
+# write todo markup changes for completed and deleted Google tasks
+apply_todo_edits()
+
+# remove deleted Quiver todos from Google tasks, keeping failed deletions for the next run
+#   Tasks that are already gone (404, 410) need no deleting.
+failed = []
+with metrics.phase('delete'):
+  for tid, (result, e) in zip(stale, batch_execute(service, [delete_task(tid) for tid in stale])):
+    if e is not None and getattr(getattr(e, 'resp', None), 'status', None) not in (404, 410):
+      print(e)
+      failed.append(tid)
+with state:
+  state.execute("INSERT OR REPLACE INTO state VALUES ('stale', ?)", (json.dumps(failed),))
+
+# create new Google tasks for new Quiver todos, committing their ids after each batch
+rows = state.execute('SELECT rowid, note, title, due FROM tasks WHERE id IS NULL').fetchall()
+items = normalize_dates({ 'rowid': r[0], 'notes': '[ '+r[1]+' ]', 'title': r[2], 'due': r[3] } for r in rows)
+with metrics.phase('create'):
+  for item, result, e in counted('gtasks', gtasks_sink(service, items, activelist, handled=state.commit)):
+    if e is not None:
+      print(e)
+    else:
+      state.execute('UPDATE tasks SET id = ? WHERE rowid = ?', (activelist+'/'+result['id'], item['rowid']))
+
+# record time of this run in synchronization state
+with state:
+  state.execute("INSERT OR REPLACE INTO state VALUES ('lastrun', ?)", (thisrun,))
+report()
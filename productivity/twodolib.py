@@ -0,0 +1,78 @@
+# Helpers for sending tasks to 2Do, shared by the 2Do scripts
+
+import os, sys, time, threading, subprocess, urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'quiver'))
+import metrics
+
+# settings
+sinkName  = os.environ.get('TWODO_SINK', 'open')   # open, stdout or file:<path>
+batchSize = 10                                     # urls per open command
+poolSize  = 2                                      # concurrent open commands
+maxRate   = 5.0                                    # maximum urls per second
+
+# x-callback url to add a 2Do task
+#   params: task parameters (dictionary)
+#   returns: url
+def add_url(task):
+  return 'twodo://x-callback-url/add?' + urllib.parse.urlencode(task).replace('+', '%20')
+
+# send urls with the macOS open command (without a shell, so titles need no quoting)
+def _open(urls):
+  subprocess.run(['open'] + urls, check=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL)
+
+# print urls, one per line
+def _stdout(urls):
+  for url in urls:
+    sys.stdout.write(url + '\n')
+  sys.stdout.flush()
+
+_lock = threading.Lock()
+_schedule = [0.0]    # earliest time the next batch may be sent, kept across dispatch calls
+
+# sink function of a sink name
+#   params: sink name (open, stdout or file:<path>), or a function taking a list of urls
+#   returns: function taking a list of urls, raising an exception if they could not be sent
+def sink_function(name):
+  if callable(name):
+    return name
+  if name == 'open':
+    return _open
+  if name == 'stdout':
+    return _stdout
+  if name.startswith('file:'):
+    fname = os.path.expanduser(name[5:])
+    def write(urls):
+      with _lock:
+        with open(fname, 'a', encoding='utf-8') as f:
+          f.write(''.join(url + '\n' for url in urls))
+    return write
+  raise ValueError('Unknown 2Do sink: ' + name)
+
+# send x-callback urls to 2Do in rate-limited batches
+#   Urls are sent in batches of up to size urls by a bounded pool of workers,
+#   with batches spaced so that no more than rate urls are sent per second (also
+#   across calls, so a stream of urls can be dispatched a chunk at a time). If a
+#   batch fails, the error is reported for each url in it.
+#   params: list of urls, sink (see sink_function, None for the default), batch size, number of workers, urls per second
+#   returns: list of exceptions (None if sent), in the same order as the urls
+def dispatch(urls, sink=None, size=batchSize, workers=poolSize, rate=maxRate):
+  send = sink_function(sink if sink is not None else sinkName)
+  results = [None]*len(urls)
+  def run(i):
+    batch = urls[i:i+size]
+    with _lock:
+      start = max(_schedule[0], time.time())
+      _schedule[0] = start + len(batch)/rate
+    delay = start - time.time()
+    if delay > 0:
+      time.sleep(delay)
+    metrics.count('2do.dispatch', calls=len(batch), api_calls=1)
+    try:
+      send(batch)
+    except Exception as e:
+      for j in range(i, i+len(batch)):
+        results[j] = e
+  with ThreadPoolExecutor(max_workers=workers) as pool:
+    list(pool.map(run, range(0, len(urls), size)))
+  return results
@@ -0,0 +1,148 @@
+# Lightweight per-phase metrics for the Quiver and task tools
+#
+# Phases are named parts of a run (e.g. "walk", "extract", "google.batch"), for
+# which wall time, calls, bytes read and written, and API round trips are added
+# up. Metrics are only collected when enabled by the QUIVER_METRICS environment
+# variable, otherwise each phase costs one check of a module flag:
+#   QUIVER_METRICS=json:<file>   write a json report when the tool exits
+#   QUIVER_METRICS=prom:<file>   write a Prometheus textfile when the tool exits
+#   QUIVER_METRICS=stderr        print a table when the tool exits
+#   QUIVER_PROFILE=<file>        also run the tool under cProfile, and dump pstats to file
+#
+# Counters are shared by all threads of a run. Work done in a process pool (the
+# parallel export) is only timed as a whole, by the "export.pool" phase in the
+# parent: phases and counts inside the worker processes are not reported.
+#
+# Usage:
+#   metrics.start('sync')
+#   with metrics.phase('walk'):
+#     ...
+#   metrics.count('walk', bytes_read=n)
+
+import os, sys, io, time, json, atexit, functools, threading
+
+# settings
+target  = os.environ.get('QUIVER_METRICS', '')
+profile = os.environ.get('QUIVER_PROFILE', '')
+enabled = target != '' or profile != ''
+
+# phase name to counters
+phases = {}
+_tool = [None]
+_fields = ('seconds', 'calls', 'bytes_read', 'bytes_written', 'api_calls')
+_lock = threading.Lock()
+
+# a forked worker gets a fresh lock, in case another thread held it at the fork
+def _reset_lock():
+  global _lock
+  _lock = threading.Lock()
+if hasattr(os, 'register_at_fork'):
+  os.register_at_fork(after_in_child=_reset_lock)
+
+def _counters(name):
+  c = phases.get(name)
+  if c is None:
+    c = phases[name] = dict((f, 0) for f in _fields)
+  return c
+
+# add to counters of a phase
+#   params: phase name, calls, bytes read, bytes written, API round trips
+def count(name, calls=0, bytes_read=0, bytes_written=0, api_calls=0):
+  if not enabled:
+    return
+  with _lock:
+    c = _counters(name)
+    c['calls'] += calls
+    c['bytes_read'] += bytes_read
+    c['bytes_written'] += bytes_written
+    c['api_calls'] += api_calls
+
+# time a phase (context manager), counting one call
+#   Nested and repeated phases are timed separately, each adding to its own counters.
+class phase(object):
+  __slots__ = ('name', 't0')
+  def __init__(self, name):
+    self.name = name
+  def __enter__(self):
+    if enabled:
+      self.t0 = time.time()
+    return self
+  def __exit__(self, *args):
+    if enabled:
+      t = time.time() - self.t0
+      with _lock:
+        c = _counters(self.name)
+        c['seconds'] += t
+        c['calls'] += 1
+    return False
+
+# time a function, as a phase of the given name (not for generators)
+def timed(name):
+  def wrap(f):
+    @functools.wraps(f)
+    def timed_f(*args, **kwargs):
+      if not enabled:
+        return f(*args, **kwargs)
+      with phase(name):
+        return f(*args, **kwargs)
+    return timed_f
+  return wrap
+
+# write a file atomically
+def _write(fname, data):
+  with io.open(fname+'.tmp', 'w', encoding='utf-8') as f:
+    f.write(data)
+  os.replace(fname+'.tmp', fname)
+
+# metrics as a json report
+def json_report():
+  with _lock:
+    return json.dumps({ 'tool': _tool[0], 'time': time.time(), 'phases': phases }, indent=2, sort_keys=True)
+
+# metrics in Prometheus text exposition format
+def prometheus_report():
+  lines = []
+  with _lock:
+    snapshot = dict((name, dict(c)) for name, c in phases.items())
+  for f in _fields:
+    metric = 'quiver_phase_' + f + '_total'
+    lines.append('# TYPE ' + metric + ' counter')
+    for name in sorted(snapshot):
+      lines.append(metric + '{tool="' + str(_tool[0]) + '",phase="' + name.replace('"', '\\"') + '"} ' + repr(snapshot[name][f]))
+  return '\n'.join(lines) + '\n'
+
+# write the report to the configured target
+def report():
+  if target.startswith('json:'):
+    _write(target[5:], json_report())
+  elif target.startswith('prom:'):
+    _write(target[5:], prometheus_report())
+  elif target == 'stderr':
+    with _lock:
+      snapshot = dict((name, dict(c)) for name, c in phases.items())
+    for name in sorted(snapshot):
+      c = snapshot[name]
+      sys.stderr.write('%-24s %9.3f s %8d calls %12d read %12d written %6d api\n'%(
+        name, c['seconds'], c['calls'], c['bytes_read'], c['bytes_written'], c['api_calls']))
+
+# start collecting metrics for a tool run, if enabled
+#   The report is written (and the profile dumped) when the tool exits.
+#   params: tool name
+def start(tool):
+  if not enabled or _tool[0] is not None:
+    return
+  _tool[0] = tool
+  run = phase('total')
+  run.__enter__()
+  profiler = None
+  if profile != '':
+    import cProfile
+    profiler = cProfile.Profile()
+    profiler.enable()
+  def finish():
+    if profiler is not None:
+      profiler.disable()
+      profiler.dump_stats(profile)
+    run.__exit__()
+    report()
+  atexit.register(finish)
@@ -5,9 +5,14 @@
 # Usage:
 #   quiver.py list [<notebook-regex>] [<title-regex>]
 #   quiver.py pull [<notebook-regex>] [<title-regex>]
-#   quiver.py push <markdown-file>
+#   quiver.py push <markdown-file>|<folder>
+#   quiver.py search <query>
+#   quiver.py export <folder> [<notebook-regex>]
+#   quiver.py watch
 #
-# We search the Quiver database for the matching notebook and note title.
+# We search the Quiver database for the matching notebook and note title. Note
+# metadata is kept in a local catalog that is refreshed incrementally, so only
+# notebooks and notes that have changed since the last run are re-read.
 # A hyphen may be used in place of the <notebook-regex> to match all notebooks.
 # If a single note is matched, it can be exported in markdown format. If multiple
 # matches are found, a list of matching notes is displayed.
@@ -15,17 +20,42 @@
 # The markdown format uses a yaml header with meta information, and "---"
 # separated sections for Quiver cells. Code cells are enclosed in "```", while
 # all other cells are enclosed in a html "<div>" tag with appropriate attributes
-# inheritted from the JSON cells in Quiver. All resources are copied into a
-# "resources" folder.
+# inheritted from the JSON cells in Quiver. All resources referenced by the note
+# are copied into a "resources" folder, unless an identical copy is already there.
+# Exported resources are copied, unless linkResources is set, in which case they
+# are hardlinked to the Quiver library where possible (saves space, but editing an
+# exported resource in place then also changes the note in the library).
+#
+# All notes in matching notebooks may be exported in one go to a folder. Notes
+# are converted in parallel, and a manifest of exported notes is kept in the
+# folder so that only notes that have changed are exported on later runs.
+#
+# A folder of markdown files may also be pushed in one go. A manifest of the
+# files pushed is kept in the folder, so unchanged files are skipped, and notes
+# or resources that would not change are not rewritten in the Quiver library.
+#
+# Note contents (markdown, code and text cells) are also kept in a full-text
+# index alongside the catalog, so that notes can be searched for by content.
+#
+# The watch verb keeps running, and updates the catalog, full-text index, tag
+# list and @todo items as notes change (using inotify on Linux, and polling
+# otherwise), so that other tools can read them from the catalog directly.
 
-import os, json, sys, re, pathlib, shutil
-from quiverlib import quiver2md, md2quiver
+import os, json, sys, re, time, pathlib, multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from quiverlib import quiver2md_stream, rescopy, push_note, push_changed, export_note, export_stale, catalog_open, catalog_refresh, Library
+from quiverlib import search_refresh, search, todo_refresh, catalog_update, watch
+import metrics
 
 # settings
 home         = str(pathlib.Path.home())
 quiverRoot   = home+'/Dropbox/apps/Quiver.qvlibrary'     # Quiver notebook path
 trash        = 'Trash.qvnotebook'                        # Quiver trash notebook to ignore
 resourceDir  = 'resources'                               # name or resource folder
+catalogFile  = home+'/.quiver/catalog.db'                # local note catalog (kept out of Dropbox)
+manifestFile = '.quiver-export.json'                     # export manifest (in export folder)
+pushManifestFile = '.quiver-push.json'                   # push manifest (in pushed folder)
+linkResources = False                                    # hardlink exported resources to the library instead of copying
 
 # usage
 def usage():
@@ -33,7 +63,10 @@ def usage():
 Usage:
   quiver.py list [<notebook-regex>] [<title-regex>]
   quiver.py pull [<notebook-regex>] [<title-regex>]
-  quiver.py push <markdown-file>
+  quiver.py push <markdown-file>|<folder>
+  quiver.py search <query>
+  quiver.py export <folder> [<notebook-regex>]
+  quiver.py watch
 ''')
   exit(1)
 
@@ -42,12 +75,25 @@ nargs = len(sys.argv)
 if nargs < 2 or nargs > 4:
   usage()
 verb = sys.argv[1]
-if verb not in ['list', 'pull', 'push']:
+if verb not in ['list', 'pull', 'push', 'search', 'export', 'watch']:
   usage()
 if verb == 'push':
   if nargs != 3:
     usage()
-  filename = sys.argv[2]
+  filename = sys.argv[2].rstrip('/') or '/'
+elif verb == 'search':
+  if nargs != 3:
+    usage()
+  query = sys.argv[2]
+elif verb == 'export':
+  if nargs < 3:
+    usage()
+  outdir = sys.argv[2]
+  nb_regex = sys.argv[3] if nargs > 3 else '-'
+  note_regex = '-'
+elif verb == 'watch':
+  if nargs != 2:
+    usage()
 else:
   nb_regex = '-'
   note_regex = '-'
@@ -56,92 +102,96 @@ else:
   if nargs > 3:
     note_regex = sys.argv[3]
 
+metrics.start('quiver.'+verb)
+
 # print list of notes
 def print_list(notes):
   if len(notes) == 0:
     print('No matching notes')
   else:
     for note in notes:
-      print(note['notebook'], '::', note['title'])
-
-# copy resources
-# if rlist is specified, only resources in rlist are copied, and optionally renamed while copying
-def rescopy(src, dst, rlist=None):
-  if os.path.isdir(src):
-    try:
-      os.mkdir(dst)
-    except:
-      pass
-    for f in os.listdir(src):
-      if rlist is None or f in rlist:
-        f1 = rlist[f] if rlist is not None else f
-        out = os.path.join(dst, f1)
-        if f == f1:
-          print('Copying', f)
-        else:
-          print('Copying', f, '=>', f1)
-        shutil.copyfile(os.path.join(src, f), out)
+      print(note.notebook.name, '::', note.title)
 
 # push handling
+if verb == 'push' and not os.path.isdir(filename):
+  for f in push_note(filename, quiverRoot, resourceDir):
+    print('Writing', f)
+  exit(0)
+
+# bulk push handling
 if verb == 'push':
-  ctime = os.path.getctime(filename)
-  mtime = os.path.getmtime(filename)
-  with open(filename, encoding='utf-8') as f:
-    md = f.readlines()
-  md = [s.rstrip() for s in md]
-  md = '\n'.join(md)
-  _, fname = os.path.split(filename)
-  fname = re.sub(r'\.[^\.]*$', '', fname)
-  folder, meta, content, resources = md2quiver(md, ctime, mtime, fname, resourceDir)
-  try:
-    fname = os.path.join(quiverRoot, folder)
-    os.mkdir(fname)
-  except:
-    pass
-  fname = os.path.join(quiverRoot, folder, 'meta.json')
-  print('Writing', os.path.join(folder, 'meta.json'))
-  with open(fname, 'w', encoding='utf-8') as f:
-    f.write(json.dumps(meta, indent=2))
-  fname = os.path.join(quiverRoot, folder, 'content.json')
-  print('Writing', os.path.join(folder, 'content.json'))
-  with open(fname, 'w', encoding='utf-8') as f:
-    f.write(json.dumps(content, indent=2))
-  if len(resources) > 0:
-    rescopy(resourceDir, os.path.join(quiverRoot, folder, 'resources'), resources)
+  fname = os.path.join(filename, pushManifestFile)
+  manifest = {}
+  if os.path.isfile(fname):
+    with open(fname, encoding='utf-8') as f:
+      manifest = json.load(f)
+  mdfiles = []
+  for root, subdirs, files in os.walk(filename):
+    subdirs[:] = [d for d in subdirs if d != resourceDir and not d.startswith('.')]
+    for f in files:
+      if f.endswith('.md'):
+        f = os.path.relpath(os.path.join(root, f), filename)
+        entry = push_changed(os.path.join(filename, f), manifest.get(f))
+        if entry is not None:
+          mdfiles.append((f, entry))
+  if len(mdfiles) > 0:
+    with ProcessPoolExecutor(mp_context=multiprocessing.get_context('fork')) as pool:
+      jobs = [(f, entry, pool.submit(push_note, os.path.join(filename, f), quiverRoot, resourceDir, entry['uuid'])) for f, entry in mdfiles]
+      for f, entry, job in jobs:
+        try:
+          for f1 in job.result():
+            print('Writing', f1)
+          manifest[f] = entry
+        except Exception as e:
+          print(f, e)
+  for f in [f for f in manifest if not os.path.isfile(os.path.join(filename, f))]:
+    del manifest[f]
+  with open(fname+'.tmp', 'w', encoding='utf-8') as f:
+    json.dump(manifest, f, indent=2)
+  os.replace(fname+'.tmp', fname)
   exit(0)
 
 # get list of notes
-notebook = ''
-notebook_uuid = ''
-notes = []
-for root, subdirs, files in os.walk(quiverRoot):
-  if trash in root:
-    continue
-  if 'meta.json' in files:
-    fname = os.path.join(root, 'meta.json')
-    with open(fname, encoding='utf-8') as f:
-      data = json.load(f)
-    if root.endswith('qvnotebook') and 'name' in data:
-      notebook = data['name']
-      notebook_uuid = data['uuid']
-    elif root.endswith('qvnote') and 'title' in data:
-      notes.append({
-        'notebook': notebook,
-        'notebook_uuid': notebook_uuid,
-        'title': data['title'],
-        'uuid': data['uuid'],
-        'root': root
-      })
+with metrics.phase('catalog'):
+  db = catalog_open(catalogFile)
+  library = Library(quiverRoot, trash, db)
+  notes = list(library.notes())
+
+# search handling
+if verb == 'search':
+  search_refresh(db)
+  notes = search(db, query)
+  if len(notes) == 0:
+    print('No matching notes')
+  for note in notes:
+    print(note['notebook'], '::', note['title'])
+    print('  ', note['snippet'])
+  exit(0)
+
+# watch handling
+if verb == 'watch':
+  search_refresh(db)
+  todo_refresh(db)
+  print('Watching', quiverRoot)
+  for roots in watch(quiverRoot, trash):
+    if roots is None:
+      n = catalog_refresh(db, quiverRoot, trash)
+    else:
+      n = catalog_update(db, quiverRoot, roots, trash)
+    n += search_refresh(db, roots) + todo_refresh(db, roots)
+    if n > 0:
+      print(time.strftime('%Y-%m-%d %H:%M:%S'), 'Updated', n, 'entries')
+    sys.stdout.flush()
 
 # filter by notebook
 if nb_regex != '-':
   regex = re.compile(r'%s'%nb_regex, re.IGNORECASE)
-  notes = [n for n in notes if re.search(regex, n['notebook'])]
+  notes = [n for n in notes if re.search(regex, n.notebook.name)]
 
 # filter by note title
 if note_regex != '-':
   regex = re.compile(r'%s'%note_regex, re.IGNORECASE)
-  notes = [n for n in notes if re.search(regex, n['title'])]
+  notes = [n for n in notes if re.search(regex, n.title)]
 
 # show notes
 if verb == 'list':
@@ -157,14 +207,47 @@ if verb == 'pull':
     print('Too many matching notes')
     exit(2)
   note = notes[0]
-  fname = os.path.join(note['root'], 'meta.json')
-  with open(fname, encoding='utf-8') as f:
-    meta = json.load(f)
-  fname = os.path.join(note['root'], 'content.json')
-  with open(fname, encoding='utf-8') as f:
-    content = json.load(f)
-  print('Writing', note['uuid']+'.md')
-  with open(note['uuid']+'.md', 'w') as f:
-    f.write(quiver2md(content, meta, note, resourceDir))
-  rescopy(os.path.join(note['root'], 'resources'), resourceDir)
+  info = note.info()
+  print('Writing', note.uuid+'.md')
+  with open(note.uuid+'.md', 'w') as f:
+    resources = quiver2md_stream(f, note.content, info, info, resourceDir)
+  for f, _ in rescopy(os.path.join(note.root, 'resources'), resourceDir, resources):
+    print('Copying', f)
+  exit(0)
+
+# export handling
+if verb == 'export':
+  if not os.path.isdir(outdir):
+    os.makedirs(outdir)
+  fname = os.path.join(outdir, manifestFile)
+  manifest = {}
+  if os.path.isfile(fname):
+    with open(fname, encoding='utf-8') as f:
+      manifest = json.load(f)
+  stale = [n for n in (n.info() for n in notes) if export_stale(n, manifest.get(n['uuid']))]
+  if len(stale) > 0:
+    # the export workers' own metrics are lost, so the pool is timed as a whole
+    with metrics.phase('export.pool'), ProcessPoolExecutor(mp_context=multiprocessing.get_context('fork')) as pool:
+      jobs = [(note, pool.submit(export_note, note, outdir, resourceDir, manifest.get(note['uuid']), linkResources)) for note in stale]
+      for note, job in jobs:
+        old = manifest.get(note['uuid'])
+        try:
+          entry = job.result()
+        except Exception as e:
+          print(note['notebook'], '::', note['title'], e)
+          manifest.pop(note['uuid'], None)
+          continue
+        if old is None or old['hash'] != entry['hash']:
+          print('Writing', entry['file'])
+        manifest[note['uuid']] = entry
+  for uuid in set(manifest).difference(n.uuid for n in library.notes()):
+    print('Removing', manifest[uuid]['file'])
+    try:
+      os.remove(os.path.join(outdir, manifest[uuid]['file']))
+    except OSError:
+      pass
+    del manifest[uuid]
+  with open(fname+'.tmp', 'w', encoding='utf-8') as f:
+    json.dump(manifest, f, indent=2)
+  os.replace(fname+'.tmp', fname)
   exit(0)
@@ -1,45 +1,57 @@
-import os, calendar, re, uuid, time, pytz
+import os, io, json, select, struct, sqlite3, hashlib, shutil, collections, calendar, re, uuid, time, pytz
 import dateutil.parser
+import metrics
 
-# json to md conversion
-#   params: content.json (dictionary), meta.json (dictionary)
-#   returns: markdown string
-def quiver2md(content, meta={'tags': []}, note=None, resourceDir='resources'):
-  s = '---\n'
-  s += 'title: '+meta['title']+'\n'
-  s += 'uuid: '+meta['uuid']+'\n'
+# json to md conversion, written to a file-like object one cell at a time
+#   params: output file, content.json (dictionary), meta.json (dictionary)
+#   returns: resources referenced by the note (dictionary)
+def quiver2md_stream(out, content, meta={'tags': []}, note=None, resourceDir='resources'):
+  resources = {}
+  out.write('---\n')
+  out.write('title: '+meta['title']+'\n')
+  out.write('uuid: '+meta['uuid']+'\n')
   if note:
-    s += 'notebook: '+note['notebook']+' ('+note['notebook_uuid']+')\n'
-  s += 'tags: '+', '.join(meta['tags'])+'\n'
-  s += 'created: '+str(meta['created_at'])+'\n'
-  s += '---\n\n'
+    out.write('notebook: '+note['notebook']+' ('+note['notebook_uuid']+')\n')
+  out.write('tags: '+', '.join(meta['tags'])+'\n')
+  out.write('created: '+str(meta['created_at'])+'\n')
+  out.write('---\n\n')
   count = 0
   for cell in content['cells']:
     if count > 0:
-      s += '\n---\n\n'
+      out.write('\n---\n\n')
     if cell['type'] == 'markdown':
-      x = cell['data']
-      x = x.replace('](quiver-image-url/', ']('+resourceDir+'/')
-      s += x+'\n'
+      for r in _mdimg.findall(cell['data']):
+        resources[r] = r
+      out.write(cell['data'].replace('](quiver-image-url/', ']('+resourceDir+'/'))
+      out.write('\n')
     elif cell['type'] == 'code':
-      s += '```\n'
-      s += cell['data']+'\n'
-      s += '```\n'
+      out.write('```\n')
+      out.write(cell['data'])
+      out.write('\n```\n')
     else:
-      hdr = dict(cell)
-      del hdr['data']
-      s += '<div'
-      for k in hdr.keys():
-        s += ' '+k+'="'+hdr[k]+'"'
-      s += '>\n'
+      out.write('<div')
+      for k in cell:
+        if k != 'data':
+          out.write(' '+k+'="'+cell[k]+'"')
+      out.write('>\n')
       x = cell['data']
       if cell['type'] == 'text':
+        for r in _htmlimg.findall(x):
+          resources[r] = r
         x = x.replace('img src="quiver-image-url/', 'img src="'+resourceDir+'/')
-      s += x+'\n'
-      s += '</div>\n'
+      out.write(x)
+      out.write('\n</div>\n')
     count += 1
-  s += '\n'
-  return s
+  out.write('\n')
+  return resources
+
+# json to md conversion
+#   params: content.json (dictionary), meta.json (dictionary)
+#   returns: markdown string
+def quiver2md(content, meta={'tags': []}, note=None, resourceDir='resources'):
+  out = io.StringIO()
+  quiver2md_stream(out, content, meta, note, resourceDir)
+  return out.getvalue()
 
 # check if a string is a yaml header
 def _isyaml(s):
@@ -66,27 +78,65 @@ def _epoch(s):
     pass
   return 0
 
-# md to json conversion
-#   params: md (markdown string)
+# split markdown lines into "---" separated cells
+#   params: iterable of lines (e.g. a file object)
+#   returns: generator of cells
+def _mdcells(lines):
+  cell = []
+  for line in lines:
+    if line.endswith('---\n'):
+      cell.append(line[:-4])
+      yield ''.join(cell)
+      cell = []
+    else:
+      cell.append(line)
+  yield ''.join(cell)
+
+# remove one leading and up to two trailing newlines (same as ^\n and \n$ substitutions)
+def _mdtrim(s):
+  if s.startswith('\n'):
+    s = s[1:]
+  if s.endswith('\n\n'):
+    return s[:-2]
+  if s.endswith('\n'):
+    return s[:-1]
+  return s
+
+_yamlline  = re.compile(r'^(\w+): *(.*)$')
+_nbuuid    = re.compile(r'^.*\((.*)\)$')
+_divopen   = re.compile(r'^<div[^>]*>\s*')
+_divclose  = re.compile(r'\s*</div>$')
+_divattrs  = re.compile(r'^<div\s+([^>]*) *>')
+_divattr   = re.compile(r'\s*(\w+)\s*=\s*"([^"]*)"')
+_htmlimg   = re.compile(r'img src="quiver-image-url/([^"]*)"')
+_mdimg     = re.compile(r'quiver-image-url/([^\)]*)\)')
+
+# md to json conversion, reading from a file-like object one cell at a time
+#   params: iterable of markdown lines (e.g. a file object), ..., note uuid if there is none in the front matter (None for a new one)
 #   returns: folder (string), meta.json (dictionary), content.json (dictionary), resources (dictionary)
-def md2quiver(md, ctime=time.time(), mtime=time.time(), title='', resourceDir='resources'):
+def md2quiver_stream(lines, ctime=time.time(), mtime=time.time(), title='', resourceDir='resources', noteuuid=None):
   resources = {}
-  cells = md.split('---\n')
+  cells = _mdcells(lines)
   yaml = {
     'title': title,
-    'uuid': str(uuid.uuid4()).upper(),
+    'uuid': noteuuid or str(uuid.uuid4()).upper(),
     'notebook': 'Inbox (Inbox)',
     'tags': None,
     'created': ctime
   }
-  if len(cells) > 2 and cells[0] == '' and _isyaml(cells[1]):
-    for s in cells[1].split('\n'):
-      m = re.match(r'^(\w+): *(.*)$', s)
+  head = []
+  for cell in cells:
+    head.append(cell)
+    if len(head) == 3 or head[0] != '':
+      break
+  if len(head) > 2 and _isyaml(head[1]):
+    for s in head[1].split('\n'):
+      m = _yamlline.match(s)
       if m:
         yaml[m.group(1)] = m.group(2)
-    cells = cells[2:]
+    head = head[2:]
   nb = yaml['notebook']
-  m = re.match(r'^.*\((.*)\)$', nb)
+  m = _nbuuid.match(nb)
   if m:
     nb = m.group(1)
   fname = os.path.join(nb+'.qvnotebook', yaml['uuid']+'.qvnote')
@@ -101,31 +151,851 @@ def md2quiver(md, ctime=time.time(), mtime=time.time(), title='', resourceDir='r
     'title': yaml['title'],
     'cells': []
   }
-  cells = [re.sub(r'\n$', '', re.sub(r'^\n', '', s)) for s in cells]
+  for cell in head:
+    content['cells'].append(_mdcell(_mdtrim(cell), resourceDir, resources))
   for cell in cells:
-    s = cell.strip()
-    if s.startswith('```\n') and s.endswith('\n```'):
-      content['cells'].append({ 'type': 'code', 'data': cell[4:-4] })
-    elif s.startswith('<div') and s.endswith('</div>'):
-      cell = re.sub(r'^<div[^>]*>\s*', '', cell)
-      cell = re.sub(r'\s*</div>$', '', cell)
-      cell = cell.replace('img src="'+resourceDir+'/', 'img src="quiver-image-url/')
-      rlist = re.findall(r'img src="quiver-image-url/([^"]*)"', cell)
-      for r in rlist:
-        resources[r] = r
-      data = { 'data': cell }
-      m = re.match(r'^<div\s+([^>]*) *>', s)
+    content['cells'].append(_mdcell(_mdtrim(cell), resourceDir, resources))
+  return fname, meta, content, resources
+
+# convert a single markdown cell to a Quiver cell, noting resources used
+def _mdcell(cell, resourceDir, resources):
+  s = cell.strip()
+  if s.startswith('```\n') and s.endswith('\n```'):
+    return { 'type': 'code', 'data': cell[4:-4] }
+  if s.startswith('<div') and s.endswith('</div>'):
+    cell = _divopen.sub('', cell)
+    cell = _divclose.sub('', cell)
+    cell = cell.replace('img src="'+resourceDir+'/', 'img src="quiver-image-url/')
+    for r in _htmlimg.findall(cell):
+      resources[r] = r
+    data = { 'data': cell }
+    m = _divattrs.match(s)
+    if m:
       s = m.group(1)
-      m = re.match(r'^\s*(\w+)\s*=\s*"([^"]*)"', s)
+      m = _divattr.match(s)
       while m:
         data[m.group(1)] = m.group(2)
-        s = s[len(m.group(0)):]
-        m = re.match(r'^\s*(\w+)\s*=\s*"([^"]*)"', s)
-      content['cells'].append(data)
-    else:
-      cell = cell.replace(']('+resourceDir+'/', '](quiver-image-url/')
-      rlist = re.findall(r'quiver-image-url/([^\)]*)\)', cell)
-      for r in rlist:
-        resources[r] = r
-      content['cells'].append({ 'type': 'markdown', 'data': cell })
-  return fname, meta, content, resources
+        m = _divattr.match(s, m.end())
+    return data
+  cell = cell.replace(']('+resourceDir+'/', '](quiver-image-url/')
+  for r in _mdimg.findall(cell):
+    resources[r] = r
+  return { 'type': 'markdown', 'data': cell }
+
+# md to json conversion
+#   params: md (markdown string)
+#   returns: folder (string), meta.json (dictionary), content.json (dictionary), resources (dictionary)
+def md2quiver(md, ctime=time.time(), mtime=time.time(), title='', resourceDir='resources'):
+  return md2quiver_stream(io.StringIO(md), ctime, mtime, title, resourceDir)
+
+# stat a file or folder
+#   returns: (mtime, size) or (None, None) if the path does not exist
+def _stat(path):
+  try:
+    st = os.stat(path)
+    return st.st_mtime, st.st_size
+  except OSError:
+    return None, None
+
+# load a json file
+def _loadjson(filename):
+  with io.open(filename, 'rb') as f:
+    data = f.read()
+  metrics.count('quiver.read', calls=1, bytes_read=len(data))
+  return json.loads(data.decode('utf-8'))
+
+# open (and create, if necessary) the persistent note catalog
+#   params: catalog database filename
+#   returns: sqlite3 connection
+def catalog_open(dbfile):
+  folder = os.path.dirname(dbfile)
+  if folder and not os.path.isdir(folder):
+    os.makedirs(folder)
+  db = sqlite3.connect(dbfile)
+  db.executescript('''
+    CREATE TABLE IF NOT EXISTS notebooks (
+      root TEXT PRIMARY KEY, mtime REAL, meta_mtime REAL, uuid TEXT, name TEXT
+    );
+    CREATE TABLE IF NOT EXISTS notes (
+      root TEXT PRIMARY KEY, notebook TEXT, meta_mtime REAL, meta_size INTEGER,
+      uuid TEXT, title TEXT, tags TEXT, created_at INTEGER, updated_at INTEGER
+    );
+    CREATE INDEX IF NOT EXISTS notes_notebook ON notes (notebook);
+  ''')
+  return db
+
+# update catalog entry for a single note from its meta.json
+def _catalog_note(db, nbroot, root, mtime, size):
+  data = {}
+  if mtime is not None:
+    try:
+      data = _loadjson(os.path.join(root, 'meta.json'))
+    except ValueError:
+      pass
+  db.execute('INSERT OR REPLACE INTO notes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)', (
+    root, nbroot, mtime, size, data.get('uuid'), data.get('title'),
+    json.dumps(data.get('tags', [])), data.get('created_at'), data.get('updated_at')))
+
+# bring catalog entries for a notebook up to date
+#   params: sqlite3 connection, notebook path, (mtime, meta_mtime) last recorded for the notebook (or None)
+#   returns: number of notebooks and notes re-read or removed
+def _catalog_notebook(db, nbroot, old):
+  changed = 0
+  mtime, _ = _stat(nbroot)
+  meta_mtime, _ = _stat(os.path.join(nbroot, 'meta.json'))
+  if old is None or old[1] != meta_mtime:
+    data = _loadjson(os.path.join(nbroot, 'meta.json')) if meta_mtime is not None else {}
+    db.execute('INSERT OR REPLACE INTO notebooks VALUES (?, ?, ?, ?, ?)',
+      (nbroot, old[0] if old else None, meta_mtime, data.get('uuid'), data.get('name')))
+    changed += 1
+  notes = dict((r[0], r[1:]) for r in db.execute('SELECT root, meta_mtime, meta_size FROM notes WHERE notebook = ?', (nbroot,)))
+  if old is None or old[0] != mtime:
+    listing = [os.path.join(nbroot, s) for s in os.listdir(nbroot) if s.endswith('qvnote')]
+    for root in set(notes).difference(listing):
+      changed += db.execute('DELETE FROM notes WHERE root = ?', (root,)).rowcount
+    db.execute('UPDATE notebooks SET mtime = ? WHERE root = ?', (mtime, nbroot))
+  else:
+    listing = notes.keys()
+  for root in listing:
+    stat = _stat(os.path.join(root, 'meta.json'))
+    if notes.get(root) != stat:
+      _catalog_note(db, nbroot, root, *stat)
+      changed += 1
+  return changed
+
+# remove a notebook and its notes from the catalog
+#   returns: number of notebooks and notes removed
+def _catalog_drop(db, nbroot):
+  n = db.execute('DELETE FROM notes WHERE notebook = ?', (nbroot,)).rowcount
+  return n + db.execute('DELETE FROM notebooks WHERE root = ?', (nbroot,)).rowcount
+
+# bring the catalog up to date with the Quiver library
+#   Only notebooks whose folder has changed are relisted, and only notes whose
+#   meta.json has changed are re-read, so a warm refresh costs one stat per note.
+#   params: sqlite3 connection, Quiver library path, trash notebook to ignore
+#   returns: number of notebooks and notes re-read or removed
+@metrics.timed('catalog.refresh')
+def catalog_refresh(db, quiverRoot, trash='Trash.qvnotebook'):
+  known = dict((r[0], r[1:]) for r in db.execute('SELECT root, mtime, meta_mtime FROM notebooks'))
+  changed = 0
+  with db:
+    for nb in os.listdir(quiverRoot):
+      nbroot = os.path.join(quiverRoot, nb)
+      if not nb.endswith('qvnotebook') or trash in nbroot or not os.path.isdir(nbroot):
+        continue
+      changed += _catalog_notebook(db, nbroot, known.pop(nbroot, None))
+    for nbroot in known:
+      changed += _catalog_drop(db, nbroot)
+  return changed
+
+# update the catalog for specific notebooks and notes that have changed
+#   params: sqlite3 connection, Quiver library path, notebook and note folders, trash notebook to ignore
+#   returns: number of notebooks and notes re-read or removed
+@metrics.timed('catalog.update')
+def catalog_update(db, quiverRoot, roots, trash='Trash.qvnotebook'):
+  changed = 0
+  with db:
+    for root in roots:
+      if trash in root:
+        continue
+      if root.endswith('qvnotebook'):
+        if os.path.isdir(root):
+          row = db.execute('SELECT mtime, meta_mtime FROM notebooks WHERE root = ?', (root,)).fetchone()
+          changed += _catalog_notebook(db, root, row)
+        else:
+          changed += _catalog_drop(db, root)
+      elif root.endswith('qvnote'):
+        nbroot = os.path.dirname(root)
+        if not os.path.isdir(root):
+          changed += db.execute('DELETE FROM notes WHERE root = ?', (root,)).rowcount
+        elif db.execute('SELECT 1 FROM notebooks WHERE root = ?', (nbroot,)).fetchone() is None:
+          changed += _catalog_notebook(db, nbroot, None)
+        else:
+          stat = _stat(os.path.join(root, 'meta.json'))
+          if db.execute('SELECT meta_mtime, meta_size FROM notes WHERE root = ?', (root,)).fetchone() != stat:
+            _catalog_note(db, nbroot, root, *stat)
+            changed += 1
+  return changed
+
+# list all tags used in the catalog
+#   params: sqlite3 connection
+#   returns: sorted list of tags
+def catalog_tags(db):
+  return [r[0] for r in db.execute('''
+    SELECT DISTINCT t.value FROM notes n, json_each(n.tags) t
+    WHERE n.title IS NOT NULL ORDER BY t.value
+  ''')]
+
+# list notes in catalog
+#   params: sqlite3 connection
+#   returns: list of notes (dictionaries), ordered by notebook and title
+def catalog_notes(db):
+  notes = []
+  for row in db.execute('''
+    SELECT nb.name, nb.uuid, n.title, n.uuid, n.root, n.tags, n.created_at, n.updated_at
+    FROM notes n JOIN notebooks nb ON n.notebook = nb.root
+    WHERE n.title IS NOT NULL AND nb.name IS NOT NULL
+    ORDER BY nb.name, n.title
+  '''):
+    notes.append({
+      'notebook': row[0],
+      'notebook_uuid': row[1],
+      'title': row[2],
+      'uuid': row[3],
+      'root': row[4],
+      'tags': json.loads(row[5]),
+      'created_at': row[6],
+      'updated_at': row[7]
+    })
+  return notes
+
+# searchable text of a note
+#   params: content.json (dictionary)
+#   returns: text of markdown, code and text cells
+def _search_text(content):
+  text = []
+  for cell in content['cells']:
+    if cell['type'] in ('markdown', 'code'):
+      text.append(cell['data'])
+    elif cell['type'] == 'text':
+      text.append(re.sub(r'<[^>]*>', ' ', cell['data']))
+  return '\n'.join(text)
+
+# bring the full-text index up to date with the catalog
+#   A note is re-indexed when its content.json mtime/size or updated_at changes.
+#   params: sqlite3 connection (refreshed with catalog_refresh), note folders to check (or None for all)
+#   returns: number of notes re-indexed
+@metrics.timed('search.refresh')
+def search_refresh(db, roots=None):
+  db.executescript('''
+    CREATE TABLE IF NOT EXISTS fulltext (
+      id INTEGER PRIMARY KEY, root TEXT UNIQUE, mtime REAL, size INTEGER, updated_at INTEGER
+    );
+    CREATE VIRTUAL TABLE IF NOT EXISTS fulltext_index USING fts5 (title, body);
+  ''')
+  known = dict((r[0], r[1:]) for r in db.execute('SELECT root, id, mtime, size, updated_at FROM fulltext'))
+  changed = 0
+  with db:
+    for root, title, updated_at in db.execute('SELECT root, title, updated_at FROM notes WHERE title IS NOT NULL').fetchall():
+      old = known.pop(root, None)
+      if roots is not None and root not in roots:
+        continue
+      fname = os.path.join(root, 'content.json')
+      mtime, size = _stat(fname)
+      if old is not None and old[1:] == (mtime, size, updated_at):
+        continue
+      try:
+        body = _search_text(_loadjson(fname)) if mtime is not None else ''
+      except (ValueError, KeyError):
+        body = ''
+      if old is None:
+        rowid = db.execute('INSERT INTO fulltext (root, mtime, size, updated_at) VALUES (?, ?, ?, ?)',
+          (root, mtime, size, updated_at)).lastrowid
+      else:
+        rowid = old[0]
+        db.execute('UPDATE fulltext SET mtime = ?, size = ?, updated_at = ? WHERE id = ?', (mtime, size, updated_at, rowid))
+        db.execute('DELETE FROM fulltext_index WHERE rowid = ?', (rowid,))
+      db.execute('INSERT INTO fulltext_index (rowid, title, body) VALUES (?, ?, ?)', (rowid, title, body))
+      changed += 1
+    for root in known:
+      db.execute('DELETE FROM fulltext_index WHERE rowid = ?', (known[root][0],))
+      db.execute('DELETE FROM fulltext WHERE id = ?', (known[root][0],))
+  return changed
+
+# full-text search
+#   Each word in the query must appear in the note title or body. Results are
+#   ranked by relevance, with matches in the title weighted more heavily.
+#   params: sqlite3 connection (refreshed with search_refresh), query string, maximum results
+#   returns: list of matching notes (dictionaries) with a snippet of matching text
+def search(db, query, limit=20):
+  terms = ['"'+s.replace('"', '""')+'"' for s in query.split()]
+  if len(terms) == 0:
+    return []
+  notes = []
+  for row in db.execute('''
+    SELECT nb.name, nb.uuid, n.title, n.uuid, n.root, snippet(fulltext_index, 1, '[', ']', '...', 12)
+    FROM fulltext_index
+      JOIN fulltext f ON f.id = fulltext_index.rowid
+      JOIN notes n ON n.root = f.root
+      JOIN notebooks nb ON nb.root = n.notebook
+    WHERE fulltext_index MATCH ?
+    ORDER BY bm25(fulltext_index, 10.0, 1.0)
+    LIMIT ?
+  ''', (' '.join(terms), limit)):
+    notes.append({
+      'notebook': row[0],
+      'notebook_uuid': row[1],
+      'title': row[2],
+      'uuid': row[3],
+      'root': row[4],
+      'snippet': re.sub(r'\s+', ' ', row[5]).strip()
+    })
+  return notes
+
+_tag          = re.compile(r'(?<=\s)@(\w+)(?:\(([^\)]*)\)|(?=\s|$))')
+_tagparam     = re.compile(r'\b(\w+)\b\s*=\s*([\-\+\.0-9a-zA-Z]+)')
+_tagbullet    = re.compile(r'^[\-\*]?\s*(\[.\]\s*)?')
+_tagcache     = collections.OrderedDict()
+_tagcachesize = 16384
+
+# inline tag, e.g. @todo, @due(2020-01-01) or @repeat(weekday=1, due=+1)
+#   name: tag name, args: text in parentheses (None if none),
+#   params: tuple of (key, value) pairs in args, title: line text before the tag
+InlineTag = collections.namedtuple('InlineTag', 'name args params title')
+
+# markdown line with inline tags
+#   cell: cell index, line: line index in cell, tags: dictionary of tag name to InlineTag
+TaggedLine = collections.namedtuple('TaggedLine', 'cell line tags')
+
+# tokenize the inline tags of a markdown cell in a single pass
+#   Results are memoized by the sha1 digest of the cell text, so unchanged cells
+#   are not tokenized again.
+#   params: cell text
+#   returns: tuple of (line index, dictionary of tag name to InlineTag)
+def _cell_tags(data):
+  if '@' not in data:
+    return ()
+  key = hashlib.sha1(data.encode('utf-8')).digest()
+  if key in _tagcache:
+    _tagcache[key] = _tagcache.pop(key)
+    return _tagcache[key]
+  metrics.count('quiver.tokenize', calls=1, bytes_read=len(data))
+  lines = []
+  for i, line in enumerate(data.splitlines()):
+    if '@' not in line:
+      continue
+    tags = {}
+    for m in _tag.finditer(line):
+      name, args = m.group(1), m.group(2)
+      if name in tags:
+        continue
+      title = line[:m.start()].strip()
+      title = title[_tagbullet.match(title).end():].strip()
+      params = tuple(_tagparam.findall(args)) if args is not None else ()
+      tags[name] = InlineTag(name, args, params, title)
+    if len(tags) > 0:
+      lines.append((i, tags))
+  lines = tuple(lines)
+  _tagcache[key] = lines
+  while len(_tagcache) > _tagcachesize:
+    _tagcache.popitem(last=False)
+  return lines
+
+# tokenize the inline tags of markdown cells
+#   params: iterable of cells
+#   returns: list of TaggedLine
+def inline_tags(cells):
+  tagged = []
+  for c, cell in enumerate(cells):
+    if cell['type'] == 'markdown':
+      for i, tags in _cell_tags(cell['data']):
+        tagged.append(TaggedLine(c, i, tags))
+  return tagged
+
+# @todo title and @due date of a tagged line
+#   params: dictionary of tag name to InlineTag
+#   returns: (title, due) tuple (due is None if not specified), or None if not a @todo item
+def todo_item(tags):
+  todo = tags.get('todo')
+  if todo is None or todo.args is not None:
+    return None
+  due = tags.get('due')
+  return (todo.title, due.args if due is not None and due.args else None)
+
+# extract @todo items from markdown cells
+#   params: iterable of cells
+#   returns: list of (title, due) tuples (due is None if not specified)
+def extract_todos(cells):
+  todos = []
+  for t in inline_tags(cells):
+    todo = todo_item(t.tags)
+    if todo is not None:
+      todos.append(todo)
+  return todos
+
+# bring the @todo items held in the catalog up to date
+#   A note is re-scanned when its content.json mtime/size changes. If its
+#   content.json can not be read (e.g. while Dropbox is syncing it), the todos
+#   last read are kept, and the note is re-scanned next time.
+#   params: sqlite3 connection (refreshed with catalog_refresh), note folders to check (or None for all)
+#   returns: number of notes re-scanned
+@metrics.timed('todo.refresh')
+def todo_refresh(db, roots=None):
+  db.executescript('''
+    CREATE TABLE IF NOT EXISTS todo_notes (root TEXT PRIMARY KEY, mtime REAL, size INTEGER);
+    CREATE TABLE IF NOT EXISTS todos (root TEXT, title TEXT, due TEXT);
+    CREATE INDEX IF NOT EXISTS todos_root ON todos (root);
+  ''')
+  known = dict((r[0], r[1:]) for r in db.execute('SELECT root, mtime, size FROM todo_notes'))
+  changed = 0
+  with db:
+    for (root,) in db.execute('SELECT root FROM notes').fetchall():
+      if roots is not None and root not in roots:
+        continue
+      fname = os.path.join(root, 'content.json')
+      stat = _stat(fname)
+      if known.get(root) == stat:
+        continue
+      try:
+        todos = extract_todos(content_cells(fname))
+      except (IOError, OSError, ValueError, KeyError):
+        db.execute('DELETE FROM todo_notes WHERE root = ?', (root,))
+        continue
+      db.execute('DELETE FROM todos WHERE root = ?', (root,))
+      db.executemany('INSERT INTO todos VALUES (?, ?, ?)', [(root, t[0], t[1]) for t in todos])
+      db.execute('INSERT OR REPLACE INTO todo_notes VALUES (?, ?, ?)', (root,)+stat)
+      changed += 1
+    db.execute('DELETE FROM todos WHERE root NOT IN (SELECT root FROM notes)')
+    db.execute('DELETE FROM todo_notes WHERE root NOT IN (SELECT root FROM notes)')
+  return changed
+
+# list @todo items held in the catalog
+#   Every note in the catalog is listed, also notes without todos, so that a
+#   note missing from the result has been removed from the library.
+#   params: sqlite3 connection (refreshed with todo_refresh)
+#   returns: dictionary of content.json filename to (note title, list of (title, due) tuples), where the
+#     note title is None if the meta.json of the note could not be read, and the list is None if its
+#     content.json could not be read
+def catalog_todos(db):
+  todos = {}
+  for root, note, scanned in db.execute('''
+    SELECT n.root, n.title, t.root IS NOT NULL FROM notes n LEFT JOIN todo_notes t ON t.root = n.root
+  '''):
+    todos[os.path.join(root, 'content.json')] = (note, [] if scanned else None)
+  for root, title, due in db.execute('SELECT root, title, due FROM todos ORDER BY rowid'):
+    fname = os.path.join(root, 'content.json')
+    if fname in todos and todos[fname][1] is not None:
+      todos[fname][1].append((title, due))
+  return todos
+
+# sha1 digest of a file
+def _sha1(fname):
+  h = hashlib.sha1()
+  with io.open(fname, 'rb') as f:
+    for block in iter(lambda: f.read(1 << 20), b''):
+      h.update(block)
+  return h.hexdigest()
+
+# check if two files have identical contents (same file, or same size and hash)
+def _sameblob(a, b):
+  try:
+    sa = os.stat(a)
+    sb = os.stat(b)
+  except OSError:
+    return False
+  if (sa.st_dev, sa.st_ino) == (sb.st_dev, sb.st_ino):
+    return True
+  if sa.st_size != sb.st_size:
+    return False
+  return _sha1(a) == _sha1(b)
+
+# copy resources
+# if rlist is specified, only resources in rlist are copied, and optionally renamed while copying
+# resources that are already identical at the destination are not copied
+# if link is True, resources are hardlinked rather than copied where possible (so that
+# editing the destination file in place also changes the source)
+#   returns: list of (source name, destination name) of resources copied
+@metrics.timed('resources')
+def rescopy(src, dst, rlist=None, link=False):
+  copied = []
+  if os.path.isdir(src):
+    try:
+      os.mkdir(dst)
+    except:
+      pass
+    for f in (rlist if rlist is not None else os.listdir(src)):
+      f1 = rlist[f] if rlist is not None else f
+      inp = os.path.join(src, f)
+      out = os.path.join(dst, f1)
+      if not os.path.isfile(inp):
+        continue
+      # a hardlink left by an earlier linked export is replaced by a copy, unless linking
+      if _sameblob(inp, out) and (link or not os.path.samefile(inp, out)):
+        continue
+      # never write into an existing file, as it may be a hardlink to a library resource
+      linked = False
+      if link:
+        try:
+          os.link(inp, out+'.tmp')
+          linked = True
+        except OSError:
+          pass
+      if not linked:
+        shutil.copyfile(inp, out+'.tmp')
+      os.replace(out+'.tmp', out)
+      copied.append((f, f1))
+  return copied
+
+# check if a note needs to be exported again (its content.json, meta.json or notebook may have changed)
+#   params: note (dictionary from catalog_notes), manifest entry from last export (or None)
+#   returns: True if the note may have changed since it was last exported
+def export_stale(note, old):
+  if old is None or old['updated_at'] != note['updated_at']:
+    return True
+  if old.get('notebook') != note['notebook'] or old.get('notebook_uuid') != note['notebook_uuid']:
+    return True
+  if old.get('meta') != list(_stat(os.path.join(note['root'], 'meta.json'))):
+    return True
+  return [old['mtime'], old['size']] != list(_stat(os.path.join(note['root'], 'content.json')))
+
+# export a note as markdown, along with its resources
+#   The note is only rewritten if its content.json, its meta.json (title, tags,
+#   dates) or its notebook have changed since the last export.
+#   Resources are copied, unless link is True (then they are hardlinked to the library where possible).
+#   params: note (dictionary from catalog_notes), output folder, resource folder name, manifest entry from last export (or None), link
+#   returns: manifest entry for the note
+@metrics.timed('export')
+def export_note(note, outdir, resourceDir='resources', old=None, link=False):
+  fname = os.path.join(note['root'], 'content.json')
+  mtime, size = _stat(fname)
+  with io.open(fname, 'rb') as f:
+    data = f.read()
+  metafile = os.path.join(note['root'], 'meta.json')
+  metastat = list(_stat(metafile))
+  with io.open(metafile, 'rb') as f:
+    metadata = f.read()
+  h = hashlib.sha1(data)
+  h.update(metadata)
+  h.update((note['notebook'] + '\0' + str(note['notebook_uuid'])).encode('utf-8'))
+  entry = {
+    'uuid': note['uuid'],
+    'updated_at': note['updated_at'],
+    'mtime': mtime,
+    'size': size,
+    'meta': metastat,
+    'notebook': note['notebook'],
+    'notebook_uuid': note['notebook_uuid'],
+    'hash': h.hexdigest(),
+    'file': note['uuid']+'.md'
+  }
+  out = os.path.join(outdir, entry['file'])
+  if old is not None and old['hash'] == entry['hash'] and os.path.isfile(out):
+    return entry
+  content = json.loads(data.decode('utf-8'))
+  meta = json.loads(metadata.decode('utf-8'))
+  with io.open(out+'.tmp', 'w', encoding='utf-8') as f:
+    resources = quiver2md_stream(f, content, meta, note, resourceDir)
+  os.replace(out+'.tmp', out)
+  rescopy(os.path.join(note['root'], 'resources'), os.path.join(outdir, resourceDir), resources, link=link)
+  return entry
+
+# write a file, unless it already has exactly the same contents
+#   returns: True if the file was written
+def _update(fname, data):
+  data = data.encode('utf-8')
+  try:
+    with io.open(fname, 'rb') as f:
+      if f.read() == data:
+        return False
+  except IOError:
+    pass
+  with io.open(fname+'.tmp', 'wb') as f:
+    f.write(data)
+  os.replace(fname+'.tmp', fname)
+  metrics.count('quiver.write', calls=1, bytes_written=len(data))
+  return True
+
+# strip trailing whitespace from lines, without a newline after the last line
+def _rstripped(lines):
+  prev = None
+  for line in lines:
+    if prev is not None:
+      yield prev+'\n'
+    prev = line.rstrip()
+  if prev is not None:
+    yield prev
+
+# push a markdown file into the Quiver library
+#   Resources are taken from the resource folder next to the markdown file. Files
+#   in the library are only written if their contents change.
+#   params: markdown filename, Quiver library path, resource folder name, note uuid if the file has none in its front matter (None for a new one)
+#   returns: list of files written (relative to the Quiver library)
+@metrics.timed('push')
+def push_note(filename, quiverRoot, resourceDir='resources', noteuuid=None):
+  ctime = os.path.getctime(filename)
+  mtime = os.path.getmtime(filename)
+  _, title = os.path.split(filename)
+  title = re.sub(r'\.[^\.]*$', '', title)
+  with io.open(filename, encoding='utf-8') as f:
+    folder, meta, content, resources = md2quiver_stream(_rstripped(f), ctime, mtime, title, resourceDir, noteuuid)
+  try:
+    os.mkdir(os.path.join(quiverRoot, folder))
+  except:
+    pass
+  written = []
+  for name, data in (('meta.json', meta), ('content.json', content)):
+    if _update(os.path.join(quiverRoot, folder, name), json.dumps(data, indent=2)):
+      written.append(os.path.join(folder, name))
+  if len(resources) > 0:
+    src = os.path.join(os.path.dirname(filename), resourceDir)
+    for _, f in rescopy(src, os.path.join(quiverRoot, folder, 'resources'), resources):
+      written.append(os.path.join(folder, 'resources', f))
+  return written
+
+# check if a markdown file has changed since it was last pushed
+#   The entry keeps the uuid the file was first pushed as, to push it as the same
+#   note if it has no uuid in its front matter.
+#   params: markdown filename, manifest entry from last push (or None)
+#   returns: new manifest entry if the file has changed, None otherwise
+def push_changed(filename, old):
+  mtime, size = _stat(filename)
+  if old is not None and old['mtime'] == mtime and old['size'] == size:
+    return None
+  with io.open(filename, 'rb') as f:
+    digest = hashlib.sha1(f.read()).hexdigest()
+  if old is not None and old['hash'] == digest:
+    old['mtime'] = mtime
+    old['size'] = size
+    return None
+  noteuuid = old.get('uuid') if old is not None else None
+  return { 'mtime': mtime, 'size': size, 'hash': digest, 'uuid': noteuuid or str(uuid.uuid4()).upper() }
+
+# read selected cells from a content.json file
+#   The file is parsed with the json module's C decoder, which is much faster
+#   than skipping over the other cells in Python, and only cells of the given
+#   types are kept.
+#   params: content.json filename, cell types to return
+#   returns: list of cells (dictionaries) of the requested types
+def content_cells(filename, types=('markdown',)):
+  with io.open(filename, 'rb') as f:
+    data = f.read()
+  metrics.count('quiver.scan', calls=1, bytes_read=len(data))
+  if len(data) == 0:
+    return []
+  return [cell for cell in json.loads(data.decode('utf-8'))['cells'] if cell.get('type') in types]
+
+# inotify event masks
+_IN_MODIFY      = 0x00000002
+_IN_CLOSE_WRITE = 0x00000008
+_IN_MOVED_FROM  = 0x00000040
+_IN_MOVED_TO    = 0x00000080
+_IN_CREATE      = 0x00000100
+_IN_DELETE      = 0x00000200
+_IN_DELETE_SELF = 0x00000400
+_IN_MOVE_SELF   = 0x00000800
+_IN_Q_OVERFLOW  = 0x00004000
+_IN_IGNORED     = 0x00008000
+_IN_ISDIR       = 0x40000000
+_IN_WATCH       = _IN_MODIFY | _IN_CLOSE_WRITE | _IN_MOVED_FROM | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE | _IN_DELETE_SELF | _IN_MOVE_SELF
+
+# minimal inotify wrapper (Linux only)
+class _Inotify(object):
+
+  def __init__(self):
+    import ctypes, ctypes.util
+    self._ctypes = ctypes
+    self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+    self.fd = self._libc.inotify_init1(os.O_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+    self.paths = {}
+
+  def add(self, path):
+    wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), _IN_WATCH)
+    if wd < 0:
+      raise OSError(self._ctypes.get_errno(), 'inotify_add_watch failed', path)
+    self.paths[wd] = path
+
+  # read events, waiting up to timeout seconds (forever if None)
+  #   returns: list of (watched path, mask, name) tuples
+  def read(self, timeout=None):
+    if len(select.select([self.fd], [], [], timeout)[0]) == 0:
+      return []
+    buf = os.read(self.fd, 65536)
+    events = []
+    i = 0
+    while i < len(buf):
+      wd, mask, _, n = struct.unpack_from('iIII', buf, i)
+      name = os.fsdecode(buf[i+16:i+16+n].rstrip(b'\0'))
+      i += 16+n
+      events.append((self.paths.get(wd), mask, name))
+      if mask & _IN_IGNORED:
+        self.paths.pop(wd, None)
+    return events
+
+  def close(self):
+    os.close(self.fd)
+
+# watch a notebook (or the library) and all notes in it
+def _watch_notebook(ino, nbroot):
+  ino.add(nbroot)
+  for s in os.listdir(nbroot):
+    if s.endswith('qvnote'):
+      ino.add(os.path.join(nbroot, s))
+
+# set up inotify watches on the Quiver library
+#   returns: _Inotify object, or None if inotify is unavailable or there are too many notes to watch
+def _watch_library(quiverRoot, trash):
+  try:
+    ino = _Inotify()
+  except (OSError, AttributeError, TypeError):
+    return None
+  try:
+    ino.add(quiverRoot)
+    for nb in os.listdir(quiverRoot):
+      nbroot = os.path.join(quiverRoot, nb)
+      if nb.endswith('qvnotebook') and trash not in nb and os.path.isdir(nbroot):
+        _watch_notebook(ino, nbroot)
+  except OSError:
+    ino.close()
+    return None
+  return ino
+
+# watch the Quiver library for changes
+#   Uses inotify where available, and falls back to polling otherwise. Events are
+#   debounced, so a burst of changes (e.g. from a Dropbox sync) is reported once
+#   the library has been quiet for debounce seconds.
+#   params: Quiver library path, trash notebook to ignore, debounce and polling intervals (seconds)
+#   returns: generator of sets of changed notebook and note folders (None if everything should be rechecked)
+def watch(quiverRoot, trash='Trash.qvnotebook', debounce=2.0, poll=30.0):
+  ino = _watch_library(quiverRoot, trash)
+  if ino is None:
+    while True:
+      time.sleep(poll)
+      yield None
+  try:
+    while True:
+      events = ino.read()
+      more = events
+      while len(more) > 0:
+        more = ino.read(debounce)
+        events += more
+      changed = set()
+      for path, mask, name in events:
+        if mask & _IN_Q_OVERFLOW:
+          changed = None
+          break
+        if path is None or trash in name:
+          continue
+        full = os.path.join(path, name) if name else path
+        created = mask & (_IN_CREATE | _IN_MOVED_TO) and mask & _IN_ISDIR
+        if path == quiverRoot:
+          if name.endswith('qvnotebook'):
+            changed.add(full)
+            if created:
+              try:
+                _watch_notebook(ino, full)
+              except OSError:
+                pass
+        elif path.endswith('qvnotebook'):
+          changed.add(path)
+          if name.endswith('qvnote'):
+            changed.add(full)
+            if created:
+              try:
+                ino.add(full)
+              except OSError:
+                pass
+        else:
+          changed.add(path)
+      if changed is None or len(changed) > 0:
+        yield changed
+  finally:
+    ino.close()
+
+# Quiver notebook
+class Notebook(object):
+  __slots__ = ('root', 'uuid', 'name', 'notes')
+
+  def __init__(self, root, uuid, name):
+    self.root = root
+    self.uuid = uuid
+    self.name = name
+    self.notes = []
+
+# Quiver note, with metadata held in memory and content loaded on first use
+class Note(object):
+  __slots__ = ('library', 'notebook', 'root', 'uuid', 'title', 'tags', 'created_at', 'updated_at')
+
+  def __init__(self, library, notebook, root, uuid, title, tags, created_at, updated_at):
+    self.library = library
+    self.notebook = notebook
+    self.root = root
+    self.uuid = uuid
+    self.title = title
+    self.tags = tags
+    self.created_at = created_at
+    self.updated_at = updated_at
+
+  # content.json filename
+  @property
+  def filename(self):
+    return os.path.join(self.root, 'content.json')
+
+  # content.json (dictionary), parsed on first access and cached by the library
+  @property
+  def content(self):
+    return self.library.content(self)
+
+  # list of cells in content.json
+  @property
+  def cells(self):
+    return self.content['cells']
+
+  # cells of the given types, read without caching the content unless it is already cached
+  def iter_cells(self, types=('markdown',)):
+    if self.root in self.library._cache:
+      return (cell for cell in self.cells if cell['type'] in types)
+    return content_cells(self.filename, types)
+
+  # inline tags in cells of the given types (see inline_tags)
+  def inline_tags(self, types=('markdown',)):
+    return inline_tags(self.iter_cells(types))
+
+  # note as a dictionary, as used by quiver2md and catalog_notes
+  def info(self):
+    return {
+      'notebook': self.notebook.name,
+      'notebook_uuid': self.notebook.uuid,
+      'title': self.title,
+      'uuid': self.uuid,
+      'root': self.root,
+      'tags': self.tags,
+      'created_at': self.created_at,
+      'updated_at': self.updated_at
+    }
+
+# Quiver library
+#   Notebook and note metadata is loaded up front from the catalog (an in-memory
+#   catalog is used if none is given). Parsed note content is cached, with the
+#   least recently used content dropped once the cache exceeds cachesize bytes
+#   of content.json.
+class Library(object):
+
+  def __init__(self, quiverRoot, trash='Trash.qvnotebook', catalog=None, cachesize=64*1024*1024):
+    self.root = quiverRoot
+    self.notebooks = []
+    self.cachesize = cachesize
+    self._cache = collections.OrderedDict()
+    self._cached = 0
+    if catalog is None:
+      catalog = catalog_open(':memory:')
+    catalog_refresh(catalog, quiverRoot, trash)
+    nbs = {}
+    for n in catalog_notes(catalog):
+      key = (n['notebook'], n['notebook_uuid'])
+      if key not in nbs:
+        nbs[key] = Notebook(os.path.dirname(n['root']), n['notebook_uuid'], n['notebook'])
+        self.notebooks.append(nbs[key])
+      nb = nbs[key]
+      nb.notes.append(Note(self, nb, n['root'], n['uuid'], n['title'], n['tags'], n['created_at'], n['updated_at']))
+
+  # iterate over all notes in the library
+  def notes(self):
+    for nb in self.notebooks:
+      for note in nb.notes:
+        yield note
+
+  # content.json of a note (dictionary)
+  def content(self, note):
+    if note.root in self._cache:
+      self._cache[note.root] = self._cache.pop(note.root)
+      return self._cache[note.root][0]
+    _, size = _stat(note.filename)
+    data = _loadjson(note.filename)
+    self._cache[note.root] = (data, size)
+    self._cached += size
+    while self._cached > self.cachesize and len(self._cache) > 1:
+      _, (_, size) = self._cache.popitem(last=False)
+      self._cached -= size
+    return data